@@ -43,6 +43,17 @@ class Agent(object):
         }
         return self._request('POST', url, payload)
 
+    def get_container_connections(self, container_id):
+        """容器上还有多少连接, agent 不支持或者出错返回 None"""
+        url = '/api/container/%s/connections/' % container_id
+        r = self._request('GET', url, {})
+        if r is None or r.status_code != 200:
+            return None
+        try:
+            return int(r.json()['connections'])
+        except (ValueError, KeyError, TypeError):
+            return None
+
     def add_container_vlan(self, container_id, task_id, ip_list):
         url = '/api/container/%s/addvlan/' % container_id
         payload = [{'nid': n, 'ip': ip} for (n, ip) in ip_list]
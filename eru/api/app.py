@@ -8,9 +8,9 @@ from eru.models import App
 from eru.models.appconfig import verify_appconfig
 from eru.utils.decorator import check_request_json, check_request_args
 
-from .bp import create_api_blueprint, DEFAULT_RETURN_VALUE
+from .bp import create_api_blueprint, paginated, DEFAULT_RETURN_VALUE
 
-bp = create_api_blueprint('app', __name__, url_prefix='/api/app')
+bp = create_api_blueprint('app', __name__, url_prefix='/api/app', read_replica=True)
 _log = logging.getLogger(__name__)
 
 
@@ -110,19 +110,19 @@ def list_app_env(name):
 @bp.route('/<name>/containers/', methods=['GET', ])
 def list_app_containers(name):
     app = _get_app_by_name(name)
-    return app.list_containers(g.start, g.limit)
+    return paginated(app.list_containers(g.start, g.limit, before=g.cursor))
 
 
 @bp.route('/<name>/tasks/', methods=['GET', ])
 def list_app_tasks(name):
     app = _get_app_by_name(name)
-    return app.list_tasks(g.start, g.limit)
+    return paginated(app.list_tasks(g.start, g.limit, before=g.cursor))
 
 
 @bp.route('/<name>/versions/', methods=['GET', ])
 def list_app_versions(name):
     app = _get_app_by_name(name)
-    return app.list_versions(g.start, g.limit)
+    return paginated(app.list_versions(g.start, g.limit, before=g.cursor))
 
 
 @bp.route('/<name>/images/', methods=['GET', ])
@@ -137,7 +137,7 @@ def list_version_containers(name, version):
     v = app.get_version(version)
     if not v:
         abort(404, 'Version %s not found' % version)
-    return v.list_containers(g.start, g.limit)
+    return paginated(v.list_containers(g.start, g.limit, before=g.cursor))
 
 
 @bp.route('/<name>/<version>/tasks/', methods=['GET', ])
@@ -146,4 +146,4 @@ def list_version_tasks(name, version):
     v = app.get_version(version)
     if not v:
         abort(404, 'Version %s not found' % version)
-    return v.list_tasks(g.start, g.limit)
+    return paginated(v.list_tasks(g.start, g.limit, before=g.cursor))
@@ -1,15 +1,21 @@
 # coding: utf-8
 
-from flask import Blueprint, jsonify
+from flask import Blueprint, jsonify, g
 from functools import partial
 
-from eru.utils.decorator import jsonize
+from eru.utils import encode_cursor
+from eru.utils.decorator import jsonize, use_replica
 
 
 ERROR_CODES = [400, 401, 403, 404]
+READ_ONLY_METHODS = {'GET', 'HEAD', 'OPTIONS'}
 
 
-def create_api_blueprint(name, import_name, url_prefix=None):
+def create_api_blueprint(name, import_name, url_prefix=None, read_replica=False):
+    """
+    read_replica 为 True 的话, 只接受 GET 的路由查询走从库.
+    agent 轮询状态这种要读最新数据的路由, 注册的时候给 replica=False 留在主库.
+    """
     bp = Blueprint(name, import_name, url_prefix=url_prefix)
 
     def _error_hanlder(error):
@@ -18,19 +24,37 @@ def create_api_blueprint(name, import_name, url_prefix=None):
     for code in ERROR_CODES:
         bp.errorhandler(code)(_error_hanlder)
 
-    patch_blueprint_route(bp)
+    patch_blueprint_route(bp, read_replica)
     return bp
 
 
-def patch_blueprint_route(bp):
+def patch_blueprint_route(bp, read_replica=False):
     origin_route = bp.route
 
     def patched_route(self, rule, **options):
+        replica = options.pop('replica', True)
+
         def decorator(f):
+            methods = {m.upper() for m in options.get('methods') or ['GET']}
+            if read_replica and replica and methods <= READ_ONLY_METHODS:
+                f = use_replica(f)
             origin_route(rule, **options)(jsonize(f))
         return decorator
 
     bp.route = partial(patched_route, bp)
 
 
+def paginated(items):
+    """
+    请求带了 cursor 的话返回这一页和下一页的 cursor,
+    没有下一页 next_cursor 就是 None. 不带 cursor 还是原来的列表.
+    """
+    if not g.keyset:
+        return items
+    next_cursor = None
+    if items and len(items) == g.limit:
+        next_cursor = encode_cursor(items[-1].id)
+    return {'items': items, 'next_cursor': next_cursor}
+
+
 DEFAULT_RETURN_VALUE = {'error': None}
@@ -16,7 +16,7 @@ from eru.connection import rds
 from eru.utils.decorator import check_request_json
 
 
-bp = create_api_blueprint('container', __name__, url_prefix='/api/container')
+bp = create_api_blueprint('container', __name__, url_prefix='/api/container', read_replica=True)
 _log = logging.getLogger(__name__)
 
 
@@ -39,7 +39,10 @@ def get_container(id_or_cid):
 @bp.route('/<id_or_cid>/', methods=['DELETE', ])
 def remove_container(id_or_cid):
     c = _get_container(id_or_cid)
-    dockerjob.remove_container_by_cid([c.container_id], c.host)
+    errors = dockerjob.remove_container_by_cid([c.container_id], c.host)
+    if errors:
+        # blueprint 上挂不了 500 的 errorhandler, 直接返回
+        return 500, {'error': errors[c.container_id]}
     return DEFAULT_RETURN_VALUE
 
 
@@ -75,7 +78,8 @@ def cure_container(id_or_cid):
     return DEFAULT_RETURN_VALUE
 
 
-@bp.route('/<id_or_cid>/poll/', methods=['GET', ])
+# agent 拿这个判断容器死活, 不带 cookie, 从库的延迟挡不住, 只能读主库
+@bp.route('/<id_or_cid>/poll/', methods=['GET', ], replica=False)
 def poll_container(id_or_cid):
     c = _get_container(id_or_cid)
     return {'container': c.container_id, 'status': c.is_alive}
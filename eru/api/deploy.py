@@ -8,17 +8,20 @@ from flask import abort, request
 from werkzeug import secure_filename
 
 from .bp import create_api_blueprint
+from eru.async.dockerjob import get_version_image
 from eru.async.task import (
     create_containers,
     build_docker_image,
     remove_containers,
+    prewarm_hosts,
 )
 from eru.consts import TASK_BUILD, TASK_REMOVE, TASK_CREATE
-from eru.helpers.scheduler import average_schedule, centralized_schedule
+from eru.helpers.scheduler import average_schedule, centralized_schedule, build_schedule
 from eru.ipam import ipam
 from eru.models import App, Pod, Task, Container, Host
 from eru.utils import is_strict_url
-from eru.utils.decorator import check_request_json
+from eru.utils.decorator import check_request_json, redis_lock
+from eru.utils.ensure import ensure_dir_absent
 
 bp = create_api_blueprint('deploy', __name__, url_prefix='/api/deploy')
 _log = logging.getLogger(__name__)
@@ -81,11 +84,17 @@ def create_private():
     hostname = data.get('hostname', '')
     host = hostname and Host.get_by_name(hostname) or None
 
+    image = data.get('image', '') or get_version_image(version)
+    prefer_image = image if data.get('prefer_image', False) else None
+
     task_ids, watch_keys = [], []
-    host_cores = _get_strategy(strategy)(pod, ncontainer, ncore, nshare, host)
+    host_cores = _get_strategy(strategy)(pod, ncontainer, ncore, nshare, host, prefer_image=prefer_image)
     if not host_cores:
         abort(400, 'Not enough core resources')
 
+    # 先让所有机器同时开始拉镜像, 别在建容器的时候一台一台地等
+    prewarm_hosts([h for h, _ in host_cores], image)
+
     for (host, container_count), cores in host_cores.iteritems():
         t = _create_task(
             version,
@@ -139,6 +148,7 @@ def create_public():
 
     task_ids, watch_keys = [], []
     hosts = pod.get_free_public_hosts(ncontainer)
+    prewarm_hosts(hosts, data.get('image', '') or get_version_image(version))
     for host in itertools.islice(itertools.cycle(hosts), ncontainer):
         t = _create_task(
             version,
@@ -173,15 +183,7 @@ def build_image():
     if ':' not in base:
         base = base + ':latest'
 
-    host = Host.get_random_public_host()
-    if not host:
-        abort(406, 'no host is available')
-
-    task = Task.create(TASK_BUILD, version, host, {'base': base})
-    build_docker_image.apply_async(
-        args=(task.id, base, None),
-        task_id='task:%d' % task.id
-    )
+    task = _start_build(version, base)
     return {'task': task.id, 'watch_key': task.result_key}
 
 
@@ -198,23 +200,22 @@ def build_image_v2():
     if ':' not in base:
         base = base + ':latest'
 
-    host = Host.get_random_public_host()
-    if not host:
-        abort(406, 'no host is available')
-
     # if no artifacts.zip is set
     # ignore and just do the cloning and building
+    # 先存好上传的文件再占 build 名额, 存失败了不会占着名额
     file_path = None
     if 'artifacts.zip' in request.files:
         f = request.files['artifacts.zip']
         file_path = os.path.join(tempfile.mkdtemp(), secure_filename(f.filename))
         f.save(file_path)
 
-    task = Task.create(TASK_BUILD, version, host, {'base': base})
-    build_docker_image.apply_async(
-        args=(task.id, base, file_path),
-        task_id='task:%d' % task.id
-    )
+    try:
+        task = _start_build(version, base, file_path)
+    except:
+        # 没有任务会去用这个文件了
+        if file_path:
+            ensure_dir_absent(os.path.dirname(file_path))
+        raise
     return {'task': task.id, 'watch_key': task.result_key}
 
 
@@ -273,6 +274,32 @@ def offline_version():
     return {'tasks': task_ids, 'watch_keys': watch_keys}
 
 
+@redis_lock('scheduler:build')
+def _create_build_task(version, base):
+    """选机器和记下在跑的 build 要在一把锁里, 不然并发的时候会超过每台机器的上限"""
+    host = build_schedule(version.app.name, base)
+    if not host:
+        abort(406, 'no host is available')
+
+    task = Task.create(TASK_BUILD, version, host, {'base': base})
+    host.add_build(task.id)
+    return task
+
+
+def _start_build(version, base, file_path=None):
+    task = _create_build_task(version, base)
+    try:
+        build_docker_image.apply_async(
+            args=(task.id, base, file_path),
+            task_id='task:%d' % task.id
+        )
+    except:
+        # 任务没发出去, 占的 build 名额要还回去
+        task.host.remove_build(task.id)
+        raise
+    return task
+
+
 def _create_task(version, host, ncontainer, cores, nshare, networks,
         ports, args, spec_ips, entrypoint, env, image='',
         callback_url=''):
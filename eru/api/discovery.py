@@ -0,0 +1,41 @@
+# coding: utf-8
+import time
+
+from flask import abort, request
+
+from eru.publish import get_app_snapshot, read_feed, wait_feed
+
+from .bp import create_api_blueprint
+
+bp = create_api_blueprint('discovery', __name__, url_prefix='/api/discovery')
+
+MAX_POLL_TIMEOUT = 60
+
+
+@bp.route('/feed/', methods=['GET'])
+def feed():
+    """
+    long-poll 变更流, since 是上次返回的 version.
+    没有新变更就最多等 timeout 秒, 带了 app 的话别的 app 的变更不算, 接着等.
+    reset 为 True 说明 since 之后的变更已经被裁掉了,
+    要重新拿一次全量, 再从全量返回的 version 接着拿.
+    """
+    since = request.args.get('since', type=int, default=0)
+    appname = request.args.get('app', type=str, default=None)
+    timeout = min(request.args.get('timeout', type=int, default=30), MAX_POLL_TIMEOUT)
+
+    deadline = time.time() + timeout
+    version, changes, reset = read_feed(since, appname)
+    while not (changes or reset):
+        if not wait_feed(version, deadline - time.time()):
+            break
+        version, changes, reset = read_feed(version, appname)
+    return {'version': version, 'changes': changes, 'reset': reset}
+
+
+@bp.route('/app/<appname>/', methods=['GET'])
+def get_app(appname):
+    version, r = get_app_snapshot(appname)
+    if r is None:
+        abort(404, 'App %s not published' % appname)
+    return {'version': version, 'app': r}
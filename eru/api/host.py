@@ -3,7 +3,7 @@ import logging
 
 from flask import abort, g, request
 
-from .bp import create_api_blueprint, DEFAULT_RETURN_VALUE
+from .bp import create_api_blueprint, paginated, DEFAULT_RETURN_VALUE
 
 from eru.ipam import ipam
 from eru.connection import get_docker_client
@@ -13,7 +13,7 @@ from eru.models.container import check_eip_bound
 from eru.async.task import migrate_container
 
 
-bp = create_api_blueprint('host', __name__, url_prefix='/api/host')
+bp = create_api_blueprint('host', __name__, url_prefix='/api/host', read_replica=True)
 _log = logging.getLogger(__name__)
 
 
@@ -95,7 +95,7 @@ def macvlan(id_or_name):
 @bp.route('/<id_or_name>/containers/', methods=['GET'])
 def list_host_containers(id_or_name):
     host = _get_host(id_or_name)
-    return host.list_containers(g.start, g.limit)
+    return paginated(host.list_containers(g.start, g.limit, before=g.cursor))
 
 
 @bp.route('/<id_or_name>/eip/', methods=['POST', 'DELETE', 'GET'])
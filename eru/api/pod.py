@@ -6,9 +6,9 @@ from flask import abort, g, request
 from eru.models import Pod 
 from eru.utils.decorator import check_request_json
 from eru.config import DEFAULT_CORE_SHARE, DEFAULT_MAX_SHARE_CORE
-from .bp import create_api_blueprint, DEFAULT_RETURN_VALUE
+from .bp import create_api_blueprint, paginated, DEFAULT_RETURN_VALUE
 
-bp = create_api_blueprint('pod', __name__, url_prefix='/api/pod')
+bp = create_api_blueprint('pod', __name__, url_prefix='/api/pod', read_replica=True)
 _log = logging.getLogger(__name__)
 
 
@@ -43,7 +43,7 @@ def create_pod():
 def list_pod_hosts(id_or_name):
     show_all = request.args.get('all', type=bool, default=False)
     pod = _get_pod(id_or_name)
-    return pod.list_hosts(g.start, g.limit, show_all=show_all)
+    return paginated(pod.list_hosts(g.start, g.limit, show_all=show_all, before=g.cursor))
 
 
 @bp.route('/list/', methods=['GET'])
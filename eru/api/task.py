@@ -8,10 +8,11 @@ from eru.models import Task
 from eru.connection import rds
 
 
-bp = create_api_blueprint('task', __name__, url_prefix='/api/task')
+bp = create_api_blueprint('task', __name__, url_prefix='/api/task', read_replica=True)
 
 
-@bp.route('/<task_id>/')
+# 任务状态是部署完马上来轮询的, 读主库
+@bp.route('/<task_id>/', replica=False)
 def get_task(task_id):
     task = Task.get(task_id)
     if not task:
@@ -19,7 +20,7 @@ def get_task(task_id):
     return task
 
 
-@bp.route('/<task_id>/log/')
+@bp.route('/<task_id>/log/', replica=False)
 def task_log(task_id):
     task = Task.get(task_id)
     if not task:
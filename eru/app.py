@@ -6,7 +6,8 @@ if sys.version_info < (2, 7, 10):
     requests.packages.urllib3.disable_warnings()
 
 import logging
-from flask import Flask, request, g
+import time
+from flask import Flask, request, g, abort
 from werkzeug.utils import import_string
 from gunicorn.app.wsgiapp import WSGIApplication
 
@@ -16,14 +17,18 @@ from eru.config import (
     ERU_TIMEOUT,
     ERU_WORKERS,
     ERU_WORKER_CLASS,
+    SQLALCHEMY_REPLICA_STALENESS,
 )
 from eru.async import make_celery
 from eru.models import db
+from eru.utils import decode_cursor
+from eru.utils.decorator import REPLICA_WRITE_COOKIE
 
 blueprints = (
     'app',
     'container',
     'deploy',
+    'discovery',
     'host',
     'network',
     'pod',
@@ -57,6 +62,20 @@ def create_app_with_celery(static_url_path=None):
     def init_global_vars():
         g.start = request.args.get('start', type=int, default=0)
         g.limit = request.args.get('limit', type=int, default=20)
+        # 带了 cursor 参数(第一页可以为空)就用 keyset 分页
+        g.keyset = 'cursor' in request.args
+        try:
+            g.cursor = decode_cursor(request.args.get('cursor', ''))
+        except ValueError:
+            abort(400, 'Bad cursor')
+
+    @app.after_request
+    def mark_replica_staleness(response):
+        # 写过数据库的客户端, 接下来一小段时间读主库
+        if app.config['SQLALCHEMY_REPLICA_BINDS'] and db.session_written():
+            response.set_cookie(REPLICA_WRITE_COOKIE, str(time.time()),
+                                max_age=SQLALCHEMY_REPLICA_STALENESS)
+        return response
 
     return app, celery
 
@@ -2,66 +2,125 @@
 import contextlib
 import logging
 import os
+import stat
+import tarfile
 import tempfile
+import time
 import zipfile
+from cStringIO import StringIO
 
 import docker
 from docker.utils import LogConfig, Ulimit
+from gevent.pool import Pool
 from retrying import retry
 from werkzeug.security import gen_salt
 
 from eru import config
 from eru.async.utils import replace_ports
 from eru.connection import get_docker_client
-from eru.helpers.cloner import clone_code
+from eru.helpers.cloner import archive_code
 from eru.templates import template
-from eru.utils.ensure import ensure_dir_absent, ensure_file
+from eru.utils.ensure import ensure_dir_absent
 
 
 _log = logging.getLogger(__name__)
 
 
+def _add_file(tar, name, content, mode=0644):
+    info = tarfile.TarInfo(name)
+    info.size = len(content)
+    info.mode = mode
+    info.mtime = time.time()
+    tar.addfile(info, StringIO(content))
+
+
+def _add_zip(tar, archive_file, prefix):
+    """zip 里的文件一个一个直接写进 tar, 不解压到磁盘上"""
+    with zipfile.ZipFile(archive_file) as zf:
+        for zi in zf.infolist():
+            name = zi.filename.rstrip('/')
+            if not name or name == '.git' or name.startswith('.git/'):
+                continue
+
+            info = tarfile.TarInfo(os.path.join(prefix, name))
+            info.mtime = time.mktime(zi.date_time + (0, 0, -1))
+            mode = zi.external_attr >> 16
+            if zi.filename.endswith('/'):
+                info.type = tarfile.DIRTYPE
+                info.mode = mode & 0777 or 0755
+                tar.addfile(info)
+            elif stat.S_ISLNK(mode):
+                info.type = tarfile.SYMTYPE
+                info.linkname = zf.read(zi)
+                tar.addfile(info)
+            else:
+                info.size = zi.file_size
+                info.mode = mode & 0777 or 0644
+                tar.addfile(info, zf.open(zi))
+
+
+class _SizedReader(object):
+    """
+    requests 算 body 长度的时候先找 __len__, 没有再调 fileno(),
+    SpooledTemporaryFile 一调 fileno() 就落盘了. 包一层只给 read 和 __len__.
+    """
+
+    def __init__(self, fileobj):
+        fileobj.seek(0, os.SEEK_END)
+        self._size = fileobj.tell()
+        fileobj.seek(0)
+        self._fileobj = fileobj
+
+    def __len__(self):
+        return self._size
+
+    def read(self, size=-1):
+        return self._fileobj.read(size)
+
+
 @contextlib.contextmanager
-def build_image_environment(version, base, archive_file=None):
+def build_image_context(version, base, archive_file=None):
+    """
+    build context 直接打成 tar, 小的在内存里, 超过 ERU_BUILD_CONTEXT_MEMORY MB 才落盘.
+    代码从 git mirror 或者 artifacts.zip 里直接读进 tar, 不用先放到临时目录.
+    """
     appname = version.appconfig.appname
     build_cmds = version.appconfig.build
 
     if not isinstance(build_cmds, list):
         build_cmds = [build_cmds, ]
 
-    if archive_file and os.path.isfile(archive_file):
-        # if archive_file is passed
-        build_path = os.path.dirname(archive_file)
-        code_path = os.path.join(build_path, appname)
-        f = zipfile.ZipFile(archive_file)
-        f.extractall(code_path)
-    else:
-        # checkout code of version @ version.short_sha
-        build_path = tempfile.mkdtemp()
-        code_path = os.path.join(build_path, appname)
-        clone_code(version.app.git, code_path, version.short_sha, branch=None)
-
-    # remove git history
-    ensure_dir_absent(os.path.join(code_path, '.git'))
-
-    # launcher script
-    entry = 'exec sudo -E -u %s $@' % appname
-    entry_root = 'exec $@'
-    launcher = template.render_template('launcher.jinja', entrypoint=entry)
-    launcheroot = template.render_template('launcher.jinja', entrypoint=entry_root)
-    ensure_file(os.path.join(build_path, 'launcher'), content=launcher, mode=0755)
-    ensure_file(os.path.join(build_path, 'launcheroot'), content=launcheroot, mode=0755)
-
-    # build dockerfile
-    dockerfile = template.render_template(
-        'dockerfile.jinja', base=base, appname=appname,
-        build_cmds=build_cmds, user_id=version.user_id)
-    ensure_file(os.path.join(build_path, 'Dockerfile'), content=dockerfile)
-
-    yield build_path
-
-    # clean build dir
-    ensure_dir_absent(build_path)
+    context = tempfile.SpooledTemporaryFile(max_size=config.ERU_BUILD_CONTEXT_MEMORY * 1024 * 1024)
+    try:
+        tar = tarfile.open(fileobj=context, mode='w')
+        if archive_file and os.path.isfile(archive_file):
+            # if archive_file is passed
+            _add_zip(tar, archive_file, appname)
+        else:
+            # code of version @ version.short_sha
+            archive_code(version.app.git, version.short_sha, tar, appname)
+
+        # launcher script
+        entry = 'exec sudo -E -u %s $@' % appname
+        entry_root = 'exec $@'
+        launcher = template.render_template('launcher.jinja', entrypoint=entry)
+        launcheroot = template.render_template('launcher.jinja', entrypoint=entry_root)
+        _add_file(tar, 'launcher', launcher, mode=0755)
+        _add_file(tar, 'launcheroot', launcheroot, mode=0755)
+
+        # build dockerfile
+        dockerfile = template.render_template(
+            'dockerfile.jinja', base=base, appname=appname,
+            build_cmds=build_cmds, user_id=version.user_id)
+        _add_file(tar, 'Dockerfile', dockerfile)
+        tar.close()
+
+        yield _SizedReader(context)
+    finally:
+        context.close()
+        # 上传的 zip 是放在单独的临时目录里的
+        if archive_file:
+            ensure_dir_absent(os.path.dirname(archive_file))
 
 
 def build_image(host, version, base, file_path=None):
@@ -74,8 +133,14 @@ def build_image(host, version, base, file_path=None):
     repo = '{0}/{1}'.format(config.DOCKER_REGISTRY, appname)
     tag = '{0}:{1}'.format(repo, version.short_sha)
 
-    with build_image_environment(version, base, file_path) as build_path:
-        return client.build(path=build_path, rm=True, forcerm=True, tag=tag)
+    failed = False
+    with build_image_context(version, base, file_path) as context:
+        for line in client.build(fileobj=context, custom_context=True, stream=True,
+                                 rm=True, forcerm=True, tag=tag):
+            failed = failed or 'errorDetail' in line
+            yield line
+    if not failed:
+        host.add_images(tag)
 
 
 def push_image(host, version):
@@ -87,8 +152,28 @@ def push_image(host, version):
 
 
 def pull_image(host, repo, tag):
+    """stream 读完了才算 pull 完, 这时候才记到镜像列表里"""
     client = get_docker_client(host.addr)
-    return client.pull(repo, tag=tag, stream=True, insecure_registry=config.DOCKER_REGISTRY_INSECURE)
+    failed = False
+    for line in client.pull(repo, tag=tag, stream=True, insecure_registry=config.DOCKER_REGISTRY_INSECURE):
+        failed = failed or 'errorDetail' in line
+        yield line
+    if not failed:
+        host.add_images('%s:%s' % (repo, tag))
+
+
+def get_version_image(version):
+    return '{0}/{1}:{2}'.format(config.DOCKER_REGISTRY, version.app.name, version.short_sha)
+
+
+def ensure_image(host, image):
+    """host 上没有 image 的话拉下来, 真的拉了返回 True"""
+    if host.has_image(image):
+        return False
+    repo, tag = image.split(':', 1)
+    for line in pull_image(host, repo, tag):
+        _log.info(line)
+    return True
 
 
 def create_one_container(host, version, entrypoint, env='prod', cores=None,
@@ -105,7 +190,6 @@ def create_one_container(host, version, entrypoint, env='prod', cores=None,
         args = []
 
     client = get_docker_client(host.addr)
-    local_images = {r['RepoTags'][0] for r in client.images()}
 
     appconfig = version.appconfig
     appname = appconfig.appname
@@ -137,12 +221,9 @@ def create_one_container(host, version, entrypoint, env='prod', cores=None,
         port_bindings = dict(exposes)
 
     if not image:
-        image = '{0}/{1}:{2}'.format(config.DOCKER_REGISTRY, appname, version.short_sha)
+        image = get_version_image(version)
 
-    if image not in local_images:
-        repo, tag = image.split(':', 1)
-        for line in client.pull(repo, tag, stream=True, insecure_registry=config.DOCKER_REGISTRY_INSECURE):
-            _log.info(line)
+    ensure_image(host, image)
 
     env_dict = {
         'APP_NAME': appname,
@@ -181,7 +262,7 @@ def create_one_container(host, version, entrypoint, env='prod', cores=None,
         port_bindings=port_bindings,
         extra_hosts=extra_hosts,
     )
-    container = client.create_container(
+    container_params = dict(
         image=image,
         command=cmd,
         environment=env_dict,
@@ -194,6 +275,15 @@ def create_one_container(host, version, entrypoint, env='prod', cores=None,
         cpu_shares=cpu_shares,
         ports=exposed_ports,
     )
+    try:
+        container = client.create_container(**container_params)
+    except docker.errors.APIError as e:
+        # 镜像列表是缓存, 可能有人在机器上手动删了镜像, 那就重新拉一次
+        if 'no such image' not in str(e).lower():
+            raise
+        host.remove_images(image)
+        ensure_image(host, image)
+        container = client.create_container(**container_params)
     container_id = container['Id']
 
     client.start(container=container_id)
@@ -218,7 +308,8 @@ def __retry_on_api_error(e):
     return isinstance(e, docker.errors.APIError) and '500 Server Error' in str(e)
 
 
-@retry(retry_on_exception=__retry_on_api_error)
+@retry(retry_on_exception=__retry_on_api_error,
+       stop_max_attempt_number=config.DOCKER_STOP_RETRIES, wait_fixed=1000)
 def __stop_container(client, cid):
     """为什么要包一层, 因为 https://github.com/docker/docker/issues/12738 """
     client.stop(cid)
@@ -231,39 +322,52 @@ def stop_containers(containers, host):
         __stop_container(client, c.container_id)
 
 
-def remove_host_containers(containers, host):
-    """删除这个host上的这些容器"""
-    client = get_docker_client(host.addr)
-    for c in containers:
-        try:
-            __stop_container(client, c.container_id)
-            client.remove_container(c.container_id)
-        except docker.errors.APIError as e:
-            if 'no such id' in str(e).lower():
-                _log.info('%s not found, just delete it' % c.container_id)
-                continue
+def __remove_container(client, cid):
+    try:
+        __stop_container(client, cid)
+        client.remove_container(cid)
+    except docker.errors.APIError as e:
+        if 'no such id' not in str(e).lower():
             raise
+        _log.info('%s not found, just delete it' % cid)
+
 
+def remove_container_by_cid(cids, host, deadline=None):
+    """
+    并发地停掉删掉这个host上的这些容器, 最多 DOCKER_REMOVE_CONCURRENCY 个一起.
+    整体超过 deadline 秒还没删完的算失败.
+    返回 {cid: 失败原因}, 全部成功就是空的.
+    """
+    if deadline is None:
+        deadline = config.DOCKER_REMOVE_DEADLINE
 
-def remove_container_by_cid(cids, host):
     client = get_docker_client(host.addr)
-    for cid in cids:
-        try:
-            __stop_container(client, cid)
-            client.remove_container(cid)
-        except docker.errors.APIError as e:
-            if 'no such id' in str(e).lower():
-                _log.info('%s not found, just delete it' % cid)
-                continue
-            raise
+    pool = Pool(config.DOCKER_REMOVE_CONCURRENCY)
+    jobs = {cid: pool.spawn(__remove_container, client, cid) for cid in cids}
+    pool.join(timeout=deadline)
+
+    errors = {}
+    for cid, job in jobs.iteritems():
+        if not job.ready():
+            errors[cid] = 'deadline of %ss exceeded' % deadline
+        elif not job.successful():
+            errors[cid] = str(job.exception)
+    if len(pool):
+        pool.kill(block=False)
+    for cid, error in errors.iteritems():
+        _log.error('Fail to remove container %s on host %s: %s', cid, host.name, error)
+    return errors
+
+
+def remove_host_containers(containers, host, deadline=None):
+    """删除这个host上的这些容器, 返回 {container_id: 失败原因}"""
+    return remove_container_by_cid([c.container_id for c in containers], host, deadline)
 
 
 def remove_image(version, host):
     """在host上删除掉version的镜像"""
     client = get_docker_client(host.addr)
-    appconfig = version.appconfig
-    appname = appconfig.appname
-    image = '{0}/{1}:{2}'.format(config.DOCKER_REGISTRY, appname, version.short_sha)
+    image = get_version_image(version)
     try:
         client.remove_image(image)
     except docker.errors.APIError as e:
@@ -271,3 +375,4 @@ def remove_image(version, host):
             _log.info('%s not found, just delete it' % image)
         else:
             raise
+    host.remove_images(image)
@@ -3,20 +3,25 @@ import logging
 import time
 from itertools import izip_longest
 
+import flask
 from celery import current_app
+from gevent.pool import Pool
 from more_itertools import chunked
 
 from eru import consts
 from eru.async import dockerjob
-from eru.config import DOCKER_REGISTRY
-from eru.helpers.check import wait_health_check
-from eru.helpers.scheduler import average_schedule
+from eru.agent import get_agent
+from eru.config import (DOCKER_REGISTRY, DOCKER_PREWARM_HOSTS, ERU_CREATE_CONCURRENCY,
+                        ERU_DRAIN_GRACE, ERU_DRAIN_POLL_INTERVAL)
+from eru.helpers.check import check_health
+from eru.helpers.scheduler import average_schedule, record_build
 from eru.ipam import ipam
-from eru.models import Container, Task, Image
-from eru.publish import (add_container_backends, remove_container_backends,
+from eru.models import App, Container, Task, Image, Network, Host
+from eru.publish import (add_container_backends, remove_containers_backends,
                          add_container_for_agent, remove_container_for_agent,
                          set_flag_for_agent, remove_flag_for_agent,
-                         publish_to_service_discovery)
+                         publish_to_service_discovery, republish_service_discovery,
+                         flush_publish_window)
 from eru.utils.notify import TaskNotifier
 
 
@@ -65,17 +70,81 @@ def build_docker_image(task_id, base, file_path):
             Image.create(app.id, version.id, image_url)
 
             notifier.pub_success()
+            record_build(host, app.name, base)
+
+            # 常用的机器先把新镜像拉下来
+            hosts = [Host.get_by_name(name) for name in DOCKER_PREWARM_HOSTS]
+            prewarm_hosts([h for h in hosts if h and h.is_alive], image_url)
         else:
             task.finish(consts.TASK_FAILED)
             task.reason = 'failed to push image to image hub'
             notifier.pub_fail()
         _log.info('Task<id=%s>: Done', task_id)
     finally:
+        host.remove_build(task_id)
         notifier.pub_build_finish()
 
 
 @current_app.task()
-def remove_containers(task_id, cids, rmi=False):
+def prewarm_image(host_id, image):
+    """提前把 image 拉到 host 上, 建容器的时候就不用等 pull 了"""
+    host = Host.get(host_id)
+    if not host:
+        return
+    try:
+        if dockerjob.ensure_image(host, image):
+            _log.info('Image %s prewarmed on host %s', image, host.name)
+    except Exception as e:
+        # 失败了也没关系, 建容器的时候还会再拉
+        _log.error('Fail to prewarm image %s on host %s', image, host.name)
+        _log.exception(e)
+
+
+def prewarm_hosts(hosts, image):
+    """每台机器一个任务, 并行地拉. 有没有镜像在任务里再看, 这里不去碰 docker"""
+    for host in hosts:
+        prewarm_image.apply_async(args=(host.id, image))
+
+
+def _drain_config(containers):
+    """
+    app.yaml 里 entrypoint 的 drain_grace/drain_timeout, 一批容器取最大的.
+    drain_grace 是摘掉流量之后至少等多久, drain_timeout 大于 0 的话
+    还要等 agent 报告连接数变成 0, 最多等这么久.
+    """
+    grace, timeout = 0, 0
+    for c in containers:
+        entry = c.version.appconfig.entrypoints.get(c.entrypoint, {})
+        grace = max(grace, entry.get('drain_grace', ERU_DRAIN_GRACE))
+        timeout = max(timeout, entry.get('drain_timeout', 0))
+    return grace, timeout
+
+
+def _has_connections(containers):
+    for c in containers:
+        # 拿不到连接数就当没有, 只靠 drain_grace
+        if get_agent(c.host).get_container_connections(c.container_id):
+            return True
+    return False
+
+
+def _drain_wait(containers, started):
+    """还要等多少秒, 0 就是可以停容器了"""
+    grace, timeout = _drain_config(containers)
+    elapsed = time.time() - started
+    if elapsed < grace:
+        return grace - elapsed
+    if elapsed < timeout and _has_connections(containers):
+        return min(ERU_DRAIN_POLL_INTERVAL, timeout - elapsed)
+    return 0
+
+
+@current_app.task()
+def remove_containers(task_id, cids, rmi=False, drain_async=True):
+    """
+    先摘流量, 等容器上的请求处理完了再停掉删掉.
+    drain_async 的话等的时候不占着 worker, 到点了由 drain_and_remove_containers 接着做.
+    """
     task = Task.get(task_id)
     if not task:
         _log.error('Task (id=%s) not found, quit', task_id)
@@ -89,46 +158,135 @@ def remove_containers(task_id, cids, rmi=False):
         _log.error('Task (id=%s) no container found, quit')
         return
 
-    host = containers[0].host
-
     for c in containers:
         c.in_removal = 1
 
     container_ids = [c.container_id for c in containers if c]
     try:
         set_flag_for_agent(container_ids)
-        for c in containers:
-            remove_container_backends(c)
-            _log.info('Task<id=%s>: Container (cid=%s) backends removed', task_id, c.short_id)
+        remove_containers_backends(containers)
+        _log.info('Task<id=%s>: Containers (cids=%s) backends removed', task_id, cids)
 
+        # 摘流量不走发布窗口, 排空等待要从 etcd 里真的删掉之后算起
         appnames = {c.appname for c in containers}
-        publish_to_service_discovery(*appnames)
+        publish_to_service_discovery(*appnames, immediate=True)
+    except Exception as e:
+        task.finish(consts.TASK_FAILED)
+        task.reason = str(e.message)
+        notifier.pub_fail()
+        _log.error('Task<id=%s> exception', task_id)
+        _log.exception(e)
+        return
+
+    started = time.time()
+    if drain_async:
+        drain_and_remove_containers(task_id, cids, rmi, started)
+        return
+
+    wait = _drain_wait(containers, started)
+    while wait > 0:
+        time.sleep(wait)
+        wait = _drain_wait(containers, started)
+    _remove_drained_containers(task, containers, rmi)
 
-        time.sleep(3)
 
-        dockerjob.remove_host_containers(containers, host)
-        _log.info('Task<id=%s>: Containers (cids=%s) removed', task_id, cids)
+@current_app.task()
+def drain_and_remove_containers(task_id, cids, rmi, started):
+    """没等够就按还要等的时间重新排自己, 等够了再停容器"""
+    task = Task.get(task_id)
+    if not task:
+        _log.error('Task (id=%s) not found, quit', task_id)
+        return
 
-        if rmi:
-            try:
-                dockerjob.remove_image(task.version, host)
-            except Exception as e:
-                _log.error('Task<id=%s>, fail to remove image', task_id, e)
+    containers = [c for c in Container.get_multi(cids) if c]
+    if not containers:
+        _log.error('Task (id=%s) no container found, quit', task_id)
+        return
+
+    wait = _drain_wait(containers, started)
+    if wait > 0:
+        drain_and_remove_containers.apply_async(args=(task_id, cids, rmi, started), countdown=wait)
+        return
+    _remove_drained_containers(task, containers, rmi)
+
+
+def _remove_drained_containers(task, containers, rmi):
+    """
+    删掉了的容器清掉记录, 没删掉的留着 in_removal 的状态, 原因记在 task.reason 里.
+    """
+    task_id = task.id
+    notifier = TaskNotifier(task)
+    host = containers[0].host
+    try:
+        errors = dockerjob.remove_host_containers(containers, host)
     except Exception as e:
         task.finish(consts.TASK_FAILED)
         task.reason = str(e.message)
         notifier.pub_fail()
         _log.error('Task<id=%s> exception', task_id)
         _log.exception(e)
-    else:
-        for c in containers:
-            c.delete()
-        task.finish(consts.TASK_SUCCESS)
-        task.reason = 'ok'
-        notifier.pub_success()
+        return
+
+    removed = [c for c in containers if c.container_id not in errors]
+    container_ids = [c.container_id for c in removed]
+    _log.info('Task<id=%s>: Containers (cids=%s) removed', task_id, [c.id for c in removed])
+    for c in removed:
+        c.delete()
+    # 一个都没删掉的时候不能发空的 HDEL/DEL, redis 会报错
+    if container_ids:
         remove_container_for_agent(host, container_ids)
         remove_flag_for_agent(container_ids)
-        _log.info('Task<id=%s>: Done', task_id)
+
+    if errors:
+        task.finish(consts.TASK_FAILED)
+        task.reason = '; '.join('%s: %s' % (cid[:7], e) for cid, e in errors.iteritems())
+        notifier.pub_fail()
+        _log.error('Task<id=%s>: Fail to remove %s containers', task_id, len(errors))
+        return
+
+    if rmi:
+        try:
+            dockerjob.remove_image(task.version, host)
+        except Exception as e:
+            _log.error('Task<id=%s>, fail to remove image', task_id, e)
+
+    task.finish(consts.TASK_SUCCESS)
+    task.reason = 'ok'
+    notifier.pub_success()
+    _log.info('Task<id=%s>: Done', task_id)
+
+
+@current_app.task()
+def reconcile_ip_pools(network_ids=None):
+    """在线修复 IP 池, 不给 network_ids 就修所有 macvlan network"""
+    if network_ids:
+        networks = [Network.get(i) for i in network_ids]
+    else:
+        networks = Network.query.all()
+
+    reports = {}
+    for n in networks:
+        if not n:
+            continue
+        reports[n.name] = r = n.reconcile()
+        _log.info('Network %s reconciled: %s', n.name, r)
+    return reports
+
+
+@current_app.task()
+def flush_service_discovery(appname):
+    delay = flush_publish_window(appname)
+    if delay > 0:
+        flush_service_discovery.apply_async(args=(appname,), countdown=delay)
+
+
+@current_app.task()
+def reconcile_service_discovery(appnames=None):
+    """全量重建服务发现的数据, 修正增量发布攒下来的偏差"""
+    if not appnames:
+        appnames = [app.name for app in App.query.all()]
+    republish_service_discovery(*appnames)
+    _log.info('Service discovery of %s apps reconciled', len(appnames))
 
 
 def _iter_cores(cores, ncontainer):
@@ -150,14 +308,74 @@ def _clean_failed_containers(cid):
     if not container:
         return
 
-    dockerjob.remove_container_by_cid([cid], container.host)
+    errors = dockerjob.remove_container_by_cid([cid], container.host)
+    if errors:
+        _log.error('Fail to clean container (cid=%s): %s', cid, errors[cid])
     container.delete()
 
 
+def _create_one_container(task_id, cores, spec, cidrs, spec_ips, reserved):
+    """
+    建一个容器, 分配网络, 注册到 agent 和服务发现.
+    host/version 都按 id 重新拿, 这样可以在单独的 greenlet/session 里跑.
+    成功返回 (cid, backends), 失败返回 None.
+    """
+    task = Task.get(task_id)
+    host, version = task.host, task.version
+    nshare = spec['nshare']
+
+    # 在宿主机上创建容器
+    try:
+        cid, cname = dockerjob.create_one_container(host,
+                                                    version,
+                                                    spec['entrypoint'],
+                                                    spec['env'],
+                                                    cores['full'] + cores['part'],
+                                                    ports=spec['ports'], args=spec['args'],
+                                                    cpu_shares=spec['cpu_shares'],
+                                                    image=spec['image'],
+                                                    need_network=spec['need_network'])
+    except Exception as e:
+        # 写给celery日志看
+        _log.exception(e)
+        host.release_cores(cores, nshare)
+        return None
+
+    # 容器记录下来
+    c = Container.create(cid, host, version, cname, spec['entrypoint'], cores,
+                         spec['env'], nshare, spec['callback_url'])
+
+    # 为容器创建网络栈
+    # 同时把各种信息都记录下来
+    # 如果失败, 清除掉所有记录和宿主机上的容器
+    if not ipam.allocate_ips(cidrs, cid, spec_ips, reserved=reserved):
+        _clean_failed_containers(cid)
+        return None
+
+    TaskNotifier(task).notify_agent(c)
+    add_container_for_agent(host, c)
+    add_container_backends(c)
+    backends = c.get_backends()
+
+    c.callback_report(status='start')
+    return cid, backends
+
+
+def _run_in_app_context(app, f, *args):
+    # 每个 greenlet 有自己的 app context, 也就有自己的 db session
+    with app.app_context():
+        try:
+            return f(*args)
+        except Exception as e:
+            _log.exception(e)
+            return None
+
+
 @current_app.task()
 def create_containers(task_id, ncontainer, nshare, cores, network_ids, spec_ips=None):
     """
     执行task_id的任务. 部署ncontainer个容器, 占用*_core_ids这些核, 绑定到networks这些子网
+    ERU_CREATE_CONCURRENCY 大于 1 的话同一台机器上的容器并发地建.
     """
     _log.info('Task<id=%s>: Started', task_id)
     task = Task.get(task_id)
@@ -168,69 +386,66 @@ def create_containers(task_id, ncontainer, nshare, cores, network_ids, spec_ips=
     if spec_ips is None:
         spec_ips = []
 
-    need_network = bool(network_ids)
     networks = [ipam.get_pool(n) for n in network_ids]
 
     notifier = TaskNotifier(task)
     host = task.host
     version = task.version
     entrypoint = task.props['entrypoint']
-    env = task.props['env']
-    ports = task.props['ports']
-    args = task.props['args']
-    # use raw
-    image = task.props['image']
-    callback_url = task.props['callback_url']
-    cpu_shares = int(float(nshare) / host.pod.core_share * 1024) if nshare else 1024
+    spec = {
+        'entrypoint': entrypoint,
+        'env': task.props['env'],
+        'ports': task.props['ports'],
+        'args': task.props['args'],
+        # use raw
+        'image': task.props['image'],
+        'callback_url': task.props['callback_url'],
+        'cpu_shares': int(float(nshare) / host.pod.core_share * 1024) if nshare else 1024,
+        'need_network': bool(network_ids),
+        'nshare': nshare,
+    }
 
     cids = []
-    backends = []
+    # backend -> cid, health check 的结果要对回容器
+    backends = {}
     entry = version.appconfig.entrypoints[entrypoint]
 
-    for fcores, pcores in _iter_cores(cores, ncontainer):
-        cores_for_one_container = {'full': fcores, 'part': pcores}
-        # 在宿主机上创建容器
-        try:
-            cid, cname = dockerjob.create_one_container(host,
-                                                        version,
-                                                        entrypoint,
-                                                        env,
-                                                        fcores + pcores,
-                                                        ports=ports, args=args,
-                                                        cpu_shares=cpu_shares,
-                                                        image=image,
-                                                        need_network=need_network)
-        except Exception as e:
-            # 写给celery日志看
-            _log.exception(e)
-            host.release_cores(cores_for_one_container, nshare)
-            continue
+    # 一次把所有容器要用的 IP 都拿出来, 不用每个容器都去抢一次锁
+    cidrs = [n.netspace for n in networks]
+    reserved = None
+    if cidrs and not spec_ips:
+        reserved = ipam.reserve_ips(cidrs, ncontainer)
 
-        # 容器记录下来
-        c = Container.create(cid, host, version, cname, entrypoint, cores_for_one_container, env, nshare, callback_url)
-
-        # 为容器创建网络栈
-        # 同时把各种信息都记录下来
-        # 如果失败, 清除掉所有记录和宿主机上的容器
-        # 循环下一次尝试
-        cidrs = [n.netspace for n in networks]
-        if not ipam.allocate_ips(cidrs, cid, spec_ips):
-            _clean_failed_containers(cid)
-            continue
-
-        notifier.notify_agent(c)
-        add_container_for_agent(host, c)
-        add_container_backends(c)
-        cids.append(cid)
-        backends.extend(c.get_backends())
+    jobs = [{'full': fcores, 'part': pcores} for fcores, pcores in _iter_cores(cores, ncontainer)]
+    try:
+        if ERU_CREATE_CONCURRENCY > 1 and ncontainer > 1:
+            app = flask.current_app._get_current_object()
+            pool = Pool(ERU_CREATE_CONCURRENCY)
+            results = pool.imap(lambda c: _run_in_app_context(app, _create_one_container, task_id,
+                                                              c, spec, cidrs, spec_ips, reserved), jobs)
+        else:
+            results = (_create_one_container(task_id, c, spec, cidrs, spec_ips, reserved) for c in jobs)
 
-        c.callback_report(status='start')
+        for r in results:
+            if r:
+                cids.append(r[0])
+                backends.update((b, r[0]) for b in r[1])
+    finally:
+        # 没用完的 IP 还回去
+        ipam.release_reserved_ips(reserved)
 
     health_check = entry.get('health_check', '')
     if health_check and backends:
-        urls = [b + health_check for b in backends]
-        if not wait_health_check(urls):
+        def _report(backend, ok):
+            # 每个容器一有结果就记下来, 不用等最慢的那个
+            _log.info('Task<id=%s>: Container %s health check on %s %s',
+                      task_id, backends[backend][:7], backend, 'passed' if ok else 'failed')
+
+        health = check_health(backends.keys(), health_check, on_result=_report)
+        unhealthy = sorted({backends[b] for b, ok in health.iteritems() if not ok})
+        if unhealthy:
             # TODO 这里要么回滚要么报警
+            task.reason = 'health check failed: %s' % ', '.join(cid[:7] for cid in unhealthy)
             _log.info('Task<id=%s>: Done, but something went error', task_id)
             return
 
@@ -282,6 +497,7 @@ def migrate_container(container_id, need_to_remove=True):
 
     _log.info('start migration...')
     if need_to_remove:
-        remove_containers.apply(args=(task.id, cids, False), task_id='task:%s' % task.id)
+        remove_containers.apply(args=(task.id, cids, False), kwargs={'drain_async': False},
+                                task_id='task:%s' % task.id)
     create_containers.apply(args=(task.id, 1, nshare, cores, cidrs, spec_ips), task_id='task:%s' % task.id)
     _log.info('migration done')
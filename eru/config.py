@@ -18,8 +18,18 @@ ERU_TIMEOUT = get_env('ERU_TIMEOUT', 300)
 ERU_WORKERS = get_env('ERU_WORKERS', 4)
 ERU_WORKER_CLASS = get_env('ERU_WORKER_CLASS', 'geventwebsocket.gunicorn.workers.GeventWebSocketWorker')
 ERU_AGENT_PORT = get_env('ERU_AGENT_PORT', 12345)
+ERU_CREATE_CONCURRENCY = get_env('ERU_CREATE_CONCURRENCY', 1)
+ERU_DRAIN_GRACE = get_env('ERU_DRAIN_GRACE', 3)
+ERU_DRAIN_POLL_INTERVAL = get_env('ERU_DRAIN_POLL_INTERVAL', 1)
+ERU_HEALTH_CHECK_CONCURRENCY = get_env('ERU_HEALTH_CHECK_CONCURRENCY', 200)
+ERU_TASK_LOG_BATCH_SIZE = get_env('ERU_TASK_LOG_BATCH_SIZE', 100)
+ERU_TASK_LOG_FLUSH_INTERVAL = get_env('ERU_TASK_LOG_FLUSH_INTERVAL', 0.2)
+ERU_TASK_LOG_TTL = get_env('ERU_TASK_LOG_TTL', 604800)
 
 NETWORK_PROVIDER = get_env('NETWORK_PROVIDER', 'macvlan')
+NETWORK_IP_ALLOCATOR = get_env('NETWORK_IP_ALLOCATOR', 'set')
+CALICO_POOL_CACHE_TTL = get_env('CALICO_POOL_CACHE_TTL', 300)
+IPAM_CACHE_TTL = get_env('IPAM_CACHE_TTL', 3600)
 
 DOCKER_CERT_PATH = get_env('DOCKER_CERT_PATH', '')
 DOCKER_REGISTRY = get_env('DOCKER_REGISTRY', 'docker-registry.intra.hunantv.com')
@@ -32,6 +42,11 @@ DOCKER_REGISTRY_EMAIL = get_env('DOCKER_REGISTRY_EMAIL', '')
 DOCKER_LOG_DRIVER = get_env('DOCKER_LOG_DRIVER', 'none')
 DOCKER_NETWORK_MODE = get_env('DOCKER_NETWORK_MODE', 'bridge')
 DOCKER_NETWORK_DISABLED = get_env('DOCKER_NETWORK_DISABLED', False)
+DOCKER_IMAGE_CACHE_TTL = get_env('DOCKER_IMAGE_CACHE_TTL', 600)
+DOCKER_PREWARM_HOSTS = [h for h in get_env('DOCKER_PREWARM_HOSTS', '').split(',') if h]
+DOCKER_REMOVE_CONCURRENCY = get_env('DOCKER_REMOVE_CONCURRENCY', 10)
+DOCKER_REMOVE_DEADLINE = get_env('DOCKER_REMOVE_DEADLINE', 300)
+DOCKER_STOP_RETRIES = get_env('DOCKER_STOP_RETRIES', 3)
 
 DEFAULT_CORE_SHARE = get_env('DEFAULT_CORE_SHARE', 10)
 DEFAULT_MAX_SHARE_CORE = get_env('DEFAULT_MAX_SHARE_CORE', -1)
@@ -42,22 +57,36 @@ GIT_KEY_USER = get_env('GIT_KEY_USER', '')
 GIT_KEY_ENCRYPT = get_env('GIT_KEY_ENCRYPT', '')
 GIT_USERNAME = get_env('GIT_USERNAME', '')
 GIT_PASSWORD = get_env('GIT_PASSWORD', '')
+ERU_GIT_MIRROR_PATH = get_env('ERU_GIT_MIRROR_PATH', '')
+ERU_GIT_MIRROR_MAX_SIZE = get_env('ERU_GIT_MIRROR_MAX_SIZE', 10240)
+ERU_BUILD_CONTEXT_MEMORY = get_env('ERU_BUILD_CONTEXT_MEMORY', 64)
+ERU_BUILD_MAX_PER_HOST = get_env('ERU_BUILD_MAX_PER_HOST', 2)
+ERU_BUILD_TIMEOUT = get_env('ERU_BUILD_TIMEOUT', 3600)
+ERU_BUILD_AFFINITY_TTL = get_env('ERU_BUILD_AFFINITY_TTL', 86400)
 
 MYSQL_HOST = get_env('MYSQL_HOST', '127.0.0.1')
 MYSQL_PORT = get_env('MYSQL_PORT', 3306)
 MYSQL_USER = get_env('MYSQL_USER', 'eru')
 MYSQL_PASSWORD = get_env('MYSQL_PASSWORD', '')
 MYSQL_DATABASE = get_env('MYSQL_DATABASE', 'eru')
+MYSQL_REPLICA_URIS = get_env('MYSQL_REPLICA_URIS', '')
 
 SQLALCHEMY_POOL_SIZE = get_env('SQLALCHEMY_POOL_SIZE', 100)
 SQLALCHEMY_POOL_TIMEOUT = get_env('SQLALCHEMY_POOL_TIMEOUT', 3600)
 SQLALCHEMY_POOL_RECYCLE = get_env('SQLALCHEMY_POOL_RECYCLE', 2000)
+SQLALCHEMY_REPLICA_STALENESS = get_env('SQLALCHEMY_REPLICA_STALENESS', 3)
 
 REDIS_HOST = get_env('REDIS_HOST', '127.0.0.1')
 REDIS_PORT = get_env('REDIS_PORT', 6379)
 REDIS_POOL_SIZE = get_env('REDIS_POOL_SIZE', 100)
 
 ETCD = get_env('ETCD', '127.0.0.1:2379')
+SERVICE_DISCOVERY_LAYOUT = get_env('SERVICE_DISCOVERY_LAYOUT', 'single')
+SERVICE_DISCOVERY_LEGACY_DOCUMENT = get_env('SERVICE_DISCOVERY_LEGACY_DOCUMENT', 1)
+SERVICE_DISCOVERY_FULL_INTERVAL = get_env('SERVICE_DISCOVERY_FULL_INTERVAL', 600)
+SERVICE_DISCOVERY_FEED_SIZE = get_env('SERVICE_DISCOVERY_FEED_SIZE', 10000)
+SERVICE_DISCOVERY_PUBLISH_WINDOW = get_env('SERVICE_DISCOVERY_PUBLISH_WINDOW', 0)
+SERVICE_DISCOVERY_PUBLISH_MAX_DELAY = get_env('SERVICE_DISCOVERY_PUBLISH_MAX_DELAY', 10)
 
 CELERY_ACCEPT_CONTENT = get_env('CELERY_ACCEPT_CONTENT', 'pickle,json,msgpack,yaml').split(',')
 CELERY_ENABLE_UTC = get_env('CELERY_ENABLE_UTC', False)
@@ -93,4 +122,7 @@ SQLALCHEMY_DATABASE_URI = 'mysql://{0}:{1}@{2}:{3}/{4}'.format(MYSQL_USER,
                                                                MYSQL_HOST,
                                                                MYSQL_PORT,
                                                                MYSQL_DATABASE)
+SQLALCHEMY_BINDS = {'replica%d' % i: uri for i, uri in
+                    enumerate(u for u in MYSQL_REPLICA_URIS.split(',') if u)}
+SQLALCHEMY_REPLICA_BINDS = sorted(SQLALCHEMY_BINDS)
 ADMINS = [line.split(':') for line in CELERY_ADMINS.split(',')]
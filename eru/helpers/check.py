@@ -1,25 +1,49 @@
 # coding: utf-8
 
-import time
+"""
+容器起来之后的 health check.
+用 gevent 的 pool 跑, 大批量上线的时候也不会开一堆线程,
+所有检查共用一个 requests.Session, 连接可以复用.
+"""
+
+import logging
+
+import gevent
 import requests
-from threading import Thread
-from requests.exceptions import ConnectTimeout, ReadTimeout, ConnectionError
+from gevent.pool import Pool
+from requests.adapters import HTTPAdapter
 
+from eru.config import ERU_HEALTH_CHECK_CONCURRENCY
 
-class ThreadWithResult(Thread):
 
-    def __init__(self, target, args=(), kwargs=None):
-        self.target = target
-        self.args = args
-        self.kwargs = kwargs or {}
-        self.rv = None
-        super(ThreadWithResult, self).__init__(target=target, args=args, kwargs=kwargs)
+_log = logging.getLogger(__name__)
+
+# app.yaml 里 health_check 可以只写路径, 也可以写成 dict 调这些阈值
+DEFAULT_OPTIONS = {
+    'path': '',
+    # 单次请求的超时
+    'timeout': 0.5,
+    # 最多试几次
+    'retries': 10,
+    # 第一次失败之后等多久, 之后每次翻倍, 最多等 max_interval
+    'interval': 0.5,
+    'max_interval': 2,
+}
+
+_session = requests.Session()
+_adapter = HTTPAdapter(pool_connections=ERU_HEALTH_CHECK_CONCURRENCY,
+                       pool_maxsize=ERU_HEALTH_CHECK_CONCURRENCY)
+_session.mount('http://', _adapter)
 
-    def run(self):
-        try:
-            self.rv = self.target(*self.args, **self.kwargs)
-        finally:
-            del self.target, self.args, self.kwargs
+
+def get_health_check_options(health_check):
+    """health_check 是 app.yaml 里 entrypoint 的配置, 字符串或者 dict"""
+    options = dict(DEFAULT_OPTIONS)
+    if isinstance(health_check, dict):
+        options.update((k, v) for k, v in health_check.iteritems() if k in DEFAULT_OPTIONS)
+    else:
+        options['path'] = health_check or ''
+    return options
 
 
 def _normalize_url(url):
@@ -28,23 +52,37 @@ def _normalize_url(url):
     return url
 
 
-def _check_one_url(url):
-    total = 0
-    while total < 10:
+def _check_one_url(url, timeout, retries, interval, max_interval):
+    url = _normalize_url(url)
+    for i in xrange(retries):
         try:
-            requests.get(_normalize_url(url), timeout=0.5)
-        except (ConnectTimeout, ReadTimeout, ConnectionError):
+            if _session.get(url, timeout=timeout).ok:
+                return True
+        except requests.exceptions.RequestException:
             pass
-        else:
-            return True
-        total += 1
-        time.sleep(1)
-
+        if i < retries - 1:
+            gevent.sleep(min(interval * 2 ** i, max_interval))
     return False
 
 
-def wait_health_check(urls):
-    threads = [ThreadWithResult(target=_check_one_url, args=(url,),) for url in urls]
-    [t.start() for t in threads]
-    [t.join() for t in threads]
-    return all([t.rv for t in threads])
+def check_health(backends, health_check, on_result=None):
+    """
+    并发检查 backends, 返回 {backend: True/False}.
+    on_result(backend, ok) 在每个 backend 有结果的时候马上调用, 不用等全部检查完.
+    """
+    options = get_health_check_options(health_check)
+    path = options.pop('path')
+
+    results = {}
+    pool = Pool(ERU_HEALTH_CHECK_CONCURRENCY)
+
+    def _check(backend):
+        ok = _check_one_url(backend + path, **options)
+        results[backend] = ok
+        if on_result:
+            on_result(backend, ok)
+
+    for backend in backends:
+        pool.spawn(_check, backend)
+    pool.join()
+    return results
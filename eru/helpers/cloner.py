@@ -1,10 +1,31 @@
 # coding: utf-8
 
-from pygit2 import clone_repository, RemoteCallbacks
+import fcntl
+import contextlib
+import hashlib
+import logging
+import os
+import tarfile
+import tempfile
+import time
+from cStringIO import StringIO
+
+from pygit2 import clone_repository, Repository, RemoteCallbacks
 from pygit2.credentials import Keypair, UserPass
 
 from eru.config import GIT_KEY_PUB, GIT_KEY_PRI, GIT_KEY_USER, GIT_KEY_ENCRYPT
 from eru.config import GIT_USERNAME, GIT_PASSWORD
+from eru.config import ERU_GIT_MIRROR_PATH, ERU_GIT_MIRROR_MAX_SIZE
+from eru.utils.ensure import ensure_dir, ensure_dir_absent
+
+
+_log = logging.getLogger(__name__)
+
+# git tree entry 的 filemode
+_MODE_TREE = 0040000
+_MODE_EXECUTABLE = 0100755
+_MODE_LINK = 0120000
+_MODE_SUBMODULE = 0160000
 
 
 def _get_credit(url):
@@ -24,3 +45,130 @@ def clone_code(repo_url, clone_path, revision, branch=None):
     repo.checkout('HEAD')
     obj = repo.revparse_single(revision)
     repo.checkout_tree(obj.tree)
+
+
+def archive_code(repo_url, revision, tar, prefix):
+    """
+    把 revision 的代码写进 tarfile tar 里, 放在 prefix 目录下, 不带 .git.
+    配置了 ERU_GIT_MIRROR_PATH 的话直接从本地的 bare mirror 里读, 只增量 fetch,
+    不然就还是整个 clone 到临时目录再打包.
+    """
+    if not ERU_GIT_MIRROR_PATH:
+        clone_path = tempfile.mkdtemp()
+        try:
+            clone_code(repo_url, clone_path, revision)
+            tar.add(clone_path, arcname=prefix,
+                    filter=lambda info: None if os.path.basename(info.name) == '.git' else info)
+        finally:
+            ensure_dir_absent(clone_path)
+        return
+
+    mirror_path = _mirror_path(repo_url)
+    with _locked(mirror_path):
+        repo = _get_mirror(repo_url, mirror_path, revision)
+        obj = repo.revparse_single(revision)
+        info = tarfile.TarInfo(prefix)
+        info.type, info.mode, info.mtime = tarfile.DIRTYPE, 0755, time.time()
+        tar.addfile(info)
+        _archive_tree(repo, obj.tree, tar, prefix)
+        # mtime 当作最近使用时间, 淘汰的时候看这个
+        os.utime(mirror_path, None)
+
+    evict_mirrors(keep=mirror_path)
+
+
+def _mirror_path(repo_url):
+    return os.path.join(ERU_GIT_MIRROR_PATH, hashlib.sha1(repo_url).hexdigest() + '.git')
+
+
+@contextlib.contextmanager
+def _locked(mirror_path, blocking=True):
+    """同一台机器上的 worker 共用 mirror, 用文件锁互斥"""
+    ensure_dir(ERU_GIT_MIRROR_PATH)
+    with open(mirror_path + '.lock', 'a') as f:
+        flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+        try:
+            fcntl.flock(f, flags)
+        except IOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _get_mirror(repo_url, mirror_path, revision):
+    cbs = RemoteCallbacks(_get_credit(repo_url), None)
+    if not os.path.isdir(mirror_path):
+        _log.info('Create git mirror of %s at %s', repo_url, mirror_path)
+        return clone_repository(repo_url, mirror_path, bare=True, callbacks=cbs)
+
+    repo = Repository(mirror_path)
+    try:
+        repo.revparse_single(revision)
+    except (KeyError, ValueError):
+        # 本地没有这个提交才去 fetch
+        _log.info('Fetch git mirror of %s', repo_url)
+        for remote in repo.remotes:
+            remote.fetch(callbacks=cbs)
+    return repo
+
+
+def _archive_tree(repo, tree, tar, path):
+    for entry in tree:
+        info = tarfile.TarInfo(os.path.join(path, entry.name))
+        info.mtime = time.time()
+        if entry.filemode == _MODE_TREE:
+            info.type = tarfile.DIRTYPE
+            info.mode = 0755
+            tar.addfile(info)
+            _archive_tree(repo, repo[entry.id], tar, info.name)
+        elif entry.filemode == _MODE_LINK:
+            info.type = tarfile.SYMTYPE
+            info.linkname = repo[entry.id].data
+            tar.addfile(info)
+        elif entry.filemode == _MODE_SUBMODULE:
+            # clone 的时候 submodule 也是不管的
+            continue
+        else:
+            data = repo[entry.id].data
+            info.size = len(data)
+            info.mode = 0755 if entry.filemode == _MODE_EXECUTABLE else 0644
+            tar.addfile(info, StringIO(data))
+
+
+def _dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def evict_mirrors(keep=None):
+    """mirror 总大小超过 ERU_GIT_MIRROR_MAX_SIZE MB 的话, 从最久没用的开始删"""
+    if not ERU_GIT_MIRROR_PATH or not os.path.isdir(ERU_GIT_MIRROR_PATH):
+        return
+
+    mirrors = [os.path.join(ERU_GIT_MIRROR_PATH, name) for name in os.listdir(ERU_GIT_MIRROR_PATH)
+               if name.endswith('.git')]
+    sizes = {m: _dir_size(m) for m in mirrors}
+    total = sum(sizes.itervalues())
+    limit = ERU_GIT_MIRROR_MAX_SIZE * 1024 * 1024
+
+    for m in sorted(mirrors, key=os.path.getmtime):
+        if total <= limit:
+            break
+        if m == keep:
+            continue
+        # 正在被用的就跳过
+        with _locked(m, blocking=False) as locked:
+            if not locked:
+                continue
+            _log.info('Evict git mirror %s', m)
+            ensure_dir_absent(m)
+            total -= sizes[m]
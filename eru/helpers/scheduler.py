@@ -1,8 +1,13 @@
 # coding: utf-8
 
 import operator
+import random
+import time
 from collections import Counter
 
+from eru.config import ERU_BUILD_MAX_PER_HOST, ERU_BUILD_AFFINITY_TTL
+from eru.connection import rds
+from eru.models import Host
 from eru.utils.decorator import redis_lock
 
 
@@ -12,8 +17,16 @@ def get_max_container_count(pod, ncore, nshare=0):
     return sum(host.get_max_container_count(ncore, nshare) for host in pod.get_private_hosts())
 
 
+def _prefer_image_hosts(hosts, image):
+    """已经有 image 的机器排前面, 其余顺序不变"""
+    if not image or not hosts:
+        return hosts
+    ids = Host.get_ids_with_image(hosts, image)
+    return sorted(hosts, key=lambda h: h.id not in ids)
+
+
 @redis_lock('scheduler:{pod.id}')
-def average_schedule(pod, ncontainer, ncore, nshare=0, spec_host=None):
+def average_schedule(pod, ncontainer, ncore, nshare=0, spec_host=None, prefer_image=None):
     if nshare and not pod.max_share_core:
         return {}
 
@@ -25,7 +38,7 @@ def average_schedule(pod, ncontainer, ncore, nshare=0, spec_host=None):
         return {}
 
     result = {}
-    hosts = pod.get_private_hosts()
+    hosts = _prefer_image_hosts(pod.get_private_hosts(), prefer_image)
 
     host_counter = Counter()
     used_counter = Counter()
@@ -35,9 +48,11 @@ def average_schedule(pod, ncontainer, ncore, nshare=0, spec_host=None):
         if count:
             host_counter[host] = count
 
+    # 每轮每台机器放一个, 放不满的那一轮按 hosts 的顺序, 有镜像的先放
     still_need = ncontainer
     while still_need > 0:
-        for host, count in host_counter.iteritems():
+        for host in hosts:
+            count = host_counter[host]
             if count:
                 used_counter[host] += 1
                 host_counter[host] -= 1
@@ -50,7 +65,7 @@ def average_schedule(pod, ncontainer, ncore, nshare=0, spec_host=None):
 
 
 @redis_lock('scheduler:{pod.id}')
-def centralized_schedule(pod, ncontainer, ncore, nshare=0, spec_host=None):
+def centralized_schedule(pod, ncontainer, ncore, nshare=0, spec_host=None, prefer_image=None):
     if nshare and not pod.max_share_core:
         return {}
 
@@ -64,6 +79,7 @@ def centralized_schedule(pod, ncontainer, ncore, nshare=0, spec_host=None):
     result = {}
     hosts = pod.get_private_hosts()
     sorted(hosts, key=operator.attrgetter('count'))
+    hosts = _prefer_image_hosts(hosts, prefer_image)
     still_need = ncontainer
     for host in hosts:
         count, rs = host.get_container_cores(still_need, ncore, nshare)
@@ -74,3 +90,48 @@ def centralized_schedule(pod, ncontainer, ncore, nshare=0, spec_host=None):
                 break
 
     return result
+
+
+_BUILD_APP_KEY = 'eru:build:app:%s:hosts'
+_BUILD_BASE_KEY = 'eru:build:base:%s:hosts'
+
+
+def record_build(host, appname, base):
+    """build 成功之后记一下, 这台机器上有这个 app 和 base 的 layer 缓存"""
+    now = time.time()
+    pipe = rds.pipeline()
+    for key in (_BUILD_APP_KEY % appname, _BUILD_BASE_KEY % base):
+        pipe.zadd(key, **{str(host.id): now})
+        pipe.zremrangebyscore(key, 0, now - ERU_BUILD_AFFINITY_TTL)
+        pipe.expire(key, ERU_BUILD_AFFINITY_TTL)
+    pipe.execute()
+
+
+def _recent_build_hosts(appname, base):
+    since = time.time() - ERU_BUILD_AFFINITY_TTL
+    pipe = rds.pipeline(transaction=False)
+    pipe.zrangebyscore(_BUILD_APP_KEY % appname, since, '+inf')
+    pipe.zrangebyscore(_BUILD_BASE_KEY % base, since, '+inf')
+    app_hosts, base_hosts = pipe.execute()
+    return {int(i) for i in app_hosts}, {int(i) for i in base_hosts}
+
+
+def build_schedule(appname, base):
+    """
+    挑一台 public 的机器来 build.
+    在跑的 build 少的优先, 一样多的话最近 build 过这个 app 的优先, 其次是 build 过这个 base 的,
+    都一样就随便挑. 在跑的已经有 ERU_BUILD_MAX_PER_HOST 个的机器不选, 都满了返回 None.
+    调用方要在同一把锁里 add_build, 不然并发的时候会超过上限.
+    """
+    hosts = Host.get_public_hosts()
+    if not hosts:
+        return None
+
+    loads = Host.get_build_loads(hosts)
+    app_hosts, base_hosts = _recent_build_hosts(appname, base)
+
+    candidates = [h for h in hosts if loads[h.id] < ERU_BUILD_MAX_PER_HOST]
+    if not candidates:
+        return None
+    return min(candidates, key=lambda h: (loads[h.id], h.id not in app_hosts,
+                                          h.id not in base_hosts, random.random()))
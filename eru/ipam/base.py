@@ -1,5 +1,8 @@
 # coding: utf-8
 
+from eru.ipam import cache
+
+
 class BaseIPAM(object):
 
     def add_ip_pool(self, cidr, name):
@@ -14,15 +17,46 @@ class BaseIPAM(object):
     def get_all_pools():
         """list all pools"""
 
-    def allocate_ips(cidrs, container_id, spec_ips=None):
+    def reserve_ips(self, cidrs, count):
+        """reserve count ips in each of cidrs for later allocate_ips,
+        return None if not supported"""
+
+    def release_reserved_ips(self, reserved):
+        """give back what's left in reserved"""
+
+    def allocate_ips(cidrs, container_id, spec_ips=None, reserved=None):
         """allocate ip for container_id with cidrs,
-        can specify ips with spec_ips"""
+        can specify ips with spec_ips, or take ips from reserved"""
 
     def reallocate_ips(self, container_id):
         """rebind ips back to container_id"""
 
     def get_ip_by_container(self, container_id):
         """get ip assigned to container_id"""
+        return self.get_ips_for_containers([container_id])[container_id]
+
+    def get_ips_for_containers(self, container_ids):
+        """get ips of many containers at once, returns {container_id: [WrappedIP, ...]}"""
+        result = cache.get_many(container_ids)
+        missing = [cid for cid in container_ids if cid not in result]
+        if missing:
+            loaded = self.load_ips_for_containers(missing)
+            cache.set_many(loaded)
+            result.update(loaded)
+        return result
+
+    def load_ips_for_containers(self, container_ids):
+        """uncached lookup, backends can override it with a bulk version"""
+        return {cid: self.load_ip_by_container(cid) for cid in container_ids}
+
+    def load_ip_by_container(self, container_id):
+        """uncached lookup of ip assigned to container_id"""
+
+    def refresh_ip_cache(self, container_id):
+        cache.set_many({container_id: self.load_ip_by_container(container_id)})
+
+    def invalidate_ip_cache(self, *container_ids):
+        cache.invalidate(*container_ids)
 
     def release_ip_by_container(self, container_id):
         """release all IPs with container_id"""
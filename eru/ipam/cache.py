@@ -0,0 +1,40 @@
+# coding: utf-8
+
+"""
+容器 -> IP 的缓存, macvlan 和 calico 共用.
+allocate_ips 成功之后写入, 释放/重新分配的时候删掉, 过期时间兜底.
+"""
+
+import json
+
+from eru.config import IPAM_CACHE_TTL
+from eru.connection import rds
+from eru.ipam.structure import WrappedIP
+
+
+_CONTAINER_IPS_KEY = 'eru:ipam:container:%s:ips'
+
+
+def get_many(container_ids):
+    """return {container_id: [WrappedIP, ...]}, only for cached ones"""
+    if not container_ids:
+        return {}
+    values = rds.mget([_CONTAINER_IPS_KEY % cid for cid in container_ids])
+    return {cid: [WrappedIP.from_dict(d) for d in json.loads(v)]
+            for cid, v in zip(container_ids, values) if v is not None}
+
+
+def set_many(ips):
+    """ips is {container_id: [WrappedIP, ...]}"""
+    if not ips:
+        return
+    pipe = rds.pipeline(transaction=False)
+    for cid, wrapped in ips.iteritems():
+        value = json.dumps([ip.to_dict() for ip in wrapped])
+        pipe.set(_CONTAINER_IPS_KEY % cid, value, ex=IPAM_CACHE_TTL)
+    pipe.execute()
+
+
+def invalidate(*container_ids):
+    if container_ids:
+        rds.delete(*[_CONTAINER_IPS_KEY % cid for cid in container_ids])
@@ -1,18 +1,21 @@
 # coding: utf-8
 import logging
 import os
+import threading
+import time
 
+from etcd import EtcdWatchTimedOut
 from netaddr import IPAddress, IPNetwork, AddrFormatError
 from pycalico.datastore import ETCD_SCHEME_ENV, ETCD_AUTHORITY_ENV, Rule
 from pycalico.datastore_datatypes import IPPool
 from pycalico.ipam import IPAMClient
 
 from eru.agent import get_agent
-from eru.config import ETCD
+from eru.config import ETCD, CALICO_POOL_CACHE_TTL
 from eru.ipam.base import BaseIPAM
 from eru.ipam.structure import WrappedIP, WrappedNetwork
 from eru.models.eip_pool import eip_pool
-from eru.connection import rds
+from eru.connection import rds, etcd
 
 
 def _get_client():
@@ -25,6 +28,83 @@ _log = logging.getLogger(__name__)
 _ipam = _get_client()
 _POOL_NAME_KEY = 'eru:ipam:calico:%s:pool'
 _POOL_CIDR_KEY = 'eru:ipam:calico:%s:cidr'
+_POOL_ETCD_PATH = '/calico/v1/ipam/v4/pool'
+
+
+class _PoolTable(object):
+    """
+    进程内的 calico pool 缓存, cidr -> (pool, name).
+    pool 基本不变, etcd 上 pool 目录一有变动就作废,
+    watch 断了也没关系, 最多 ttl 秒之后会重新加载.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._pools = []
+        self._by_prefix = []
+        self._loaded_at = 0
+        self._watcher_pid = None
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        self._loaded_at = 0
+
+    def _load(self):
+        pools = _ipam.get_ip_pools(4)
+        names = pools and rds.mget([_POOL_NAME_KEY % p.cidr for p in pools]) or []
+        self._pools = zip(pools, names)
+        # 最长前缀优先
+        self._by_prefix = sorted(self._pools, key=lambda (p, _): p.cidr.prefixlen, reverse=True)
+        self._loaded_at = time.time()
+
+    def _watch(self):
+        index = None
+        while True:
+            try:
+                r = etcd.watch(_POOL_ETCD_PATH, index=index, recursive=True)
+                index = r.modifiedIndex + 1
+                self.invalidate()
+            except EtcdWatchTimedOut:
+                # 一直没变化, 空闲的 watch 隔一阵就会超时, 缓存和 index 都还能用
+                continue
+            except Exception:
+                # etcd 挂了, 或者 index 太旧被清掉了(EtcdEventIndexCleared),
+                # 旧的 index 不能再用, 从当前重新 watch, 中间漏掉的变化靠重新加载补上
+                _log.debug('watch calico pools failed, retry later', exc_info=True)
+                index = None
+                self.invalidate()
+                time.sleep(1)
+
+    def _ensure_watcher(self):
+        # fork 之后线程没了, 按进程起
+        pid = os.getpid()
+        if self._watcher_pid == pid:
+            return
+        self._watcher_pid = pid
+        t = threading.Thread(target=self._watch, name='calico-pool-watcher')
+        t.daemon = True
+        t.start()
+
+    def _refresh(self):
+        with self._lock:
+            self._ensure_watcher()
+            if time.time() - self._loaded_at > self.ttl:
+                self._load()
+
+    def all(self):
+        self._refresh()
+        return self._pools
+
+    def lookup(self, ip):
+        """return (pool, name) of the most specific pool containing ip, (None, None) if no pool"""
+        self._refresh()
+        for pool, name in self._by_prefix:
+            if ip in pool.cidr:
+                return pool, name
+        return None, None
+
+
+_pool_table = _PoolTable(CALICO_POOL_CACHE_TTL)
 
 
 def _get_container_ips(container_id):
@@ -63,6 +143,7 @@ class CalicoIPAM(BaseIPAM):
 
         rds.set(_POOL_NAME_KEY % pool.cidr, name)
         rds.set(_POOL_CIDR_KEY % name, pool.cidr)
+        _pool_table.invalidate()
         return WrappedNetwork.from_calico(pool, name)
 
     def remove_ip_pool(self, cidr):
@@ -76,6 +157,7 @@ class CalicoIPAM(BaseIPAM):
         rds.delete(_POOL_CIDR_KEY % name)
         _ipam.remove_ip_pool(4, cidr)
         _ipam.remove_profile(name)
+        _pool_table.invalidate()
 
     def get_pool(self, ip):
         """ip can be either an IP or a CIDR"""
@@ -90,19 +172,17 @@ class CalicoIPAM(BaseIPAM):
             except (AddrFormatError, ValueError):
                 return
 
-        pool = _ipam.get_pool(ip)
-        name = rds.get(_POOL_NAME_KEY % pool.cidr)
-        return WrappedNetwork.from_calico(pool, name)
+        pool, name = _pool_table.lookup(ip)
+        return pool and WrappedNetwork.from_calico(pool, name) or None
 
     def get_all_pools(self):
-        pools = _ipam.get_ip_pools(4)
-        names = [rds.get(_POOL_NAME_KEY % p.cidr) for p in pools]
-        return [WrappedNetwork.from_calico(p, name) for p, name in zip(pools, names)]
+        return [WrappedNetwork.from_calico(p, name) for p, name in _pool_table.all()]
 
-    def allocate_ips(self, cidrs, container_id, spec_ips=None):
+    def allocate_ips(self, cidrs, container_id, spec_ips=None, reserved=None):
         """
         Allocate IPs for container_id, all done by calicoctl.
         If spec_ips is given, cidrs will be ignored.
+        Reservation is not supported, calico assigns IPs on agent, so reserved is ignored.
         Note: agent use calicoctl to assign IPs and it will do all the things related to calico,
             so here we only need to tell agent which ip to assign.
         Generally we give cidr to agent, and maybe IPs instead.
@@ -149,6 +229,8 @@ class CalicoIPAM(BaseIPAM):
         # add inbound profile for ports
         # allow all IPs, if already exists, ignore
 
+        self.refresh_ip_cache(container_id)
+
         # currently disabled
         # entry = container.get_entry()
         # if 'publish' in entry:
@@ -175,11 +257,17 @@ class CalicoIPAM(BaseIPAM):
         self.release_ip_by_container(container_id)
         return self.allocate_ips(None, container_id, ip_list)
 
-    def get_ip_by_container(self, container_id):
+    def load_ip_by_container(self, container_id):
         """Copied from calicoctl, must use endpoint to get IPs bound to container_id"""
-        ip_list = _get_container_ips(container_id)
-        pools = [_ipam.get_pool(ip) for ip in ip_list]
-        return [WrappedIP.from_calico(ip, pool, container_id) for ip, pool in zip(ip_list, pools)]
+        wrapped = []
+        for ip in _get_container_ips(container_id):
+            pool, _ = _pool_table.lookup(ip)
+            # 不在任何 pool 里的地址(pool 被删了之类的)没有掩码, 不要
+            if pool is None:
+                _log.warn('IP %s of container %s is not in any calico pool', ip, container_id)
+                continue
+            wrapped.append(WrappedIP.from_calico(ip, pool, container_id))
+        return wrapped
 
     def release_ip_by_container(self, container_id):
         """We don't use IPv6 addresses. Copied from calicoctl."""
@@ -195,6 +283,7 @@ class CalicoIPAM(BaseIPAM):
             ip_set = set([IPAddress(i) for i in endpoint.ipv4_nets])
             _ipam.release_ips(ip_set)
             _ipam.remove_endpoint(endpoint)
+        self.invalidate_ip_cache(container_id)
 
         try:
             _ipam.remove_workload(hostname, 'docker', container.container_id)
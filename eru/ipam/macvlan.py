@@ -7,6 +7,7 @@ from werkzeug.security import gen_salt
 from eru.agent import get_agent
 from eru.ipam.base import BaseIPAM
 from eru.ipam.structure import WrappedIP, WrappedNetwork
+from eru.models import db
 from eru.models.network import IP, Network
 from eru.models.eip_pool import eip_pool
 
@@ -35,20 +36,52 @@ class MacVLANIPAM(BaseIPAM):
         return n and WrappedNetwork.from_macvlan(n) or None
 
     def get_all_pools(self):
-        networks = Network.list_networks()
-        return [WrappedNetwork.from_macvlan(n) for n in networks if n]
+        networks = [n for n in Network.list_networks() if n]
+        sizes = Network.get_pool_sizes(networks)
+        return [WrappedNetwork.from_macvlan(n, size) for n, size in zip(networks, sizes)]
 
-    def allocate_ips(self, cidrs, container_id, spec_ips=None):
+    def reserve_ips(self, cidrs, count):
+        """
+        take count ips from each network in one go,
+        returns {cidr: [ip id, ...]} for allocate_ips to use.
+        only ids are kept so it can be shared between sessions.
+        """
+        reserved = {}
+        for cidr in cidrs:
+            n = Network.get_by_netspace(cidr)
+            if n:
+                reserved[cidr] = [ip.id for ip in n.acquire_ips(count)]
+        return reserved
+
+    def release_reserved_ips(self, reserved):
+        if not reserved:
+            return
+        ids = [i for ids in reserved.itervalues() for i in ids]
+        reserved.clear()
+        if ids:
+            IP.release_many(IP.query.filter(IP.id.in_(ids)).all())
+
+    def allocate_ips(self, cidrs, container_id, spec_ips=None, reserved=None):
         """
         allocate ips for container_id, one ip per one cidr.
         if spec_ips is given, then the ip will be in spec_ips.
+        if reserved is given, ips are taken from it before asking networks.
         note, for history reasons cidrs should always be given.
         """
         from eru.models.container import Container
 
+        def _take_ip(n):
+            if reserved and reserved.get(n.netspace):
+                return IP.get(reserved[n.netspace].pop())
+            return n.acquire_ip()
+
         def _release_ips(ips):
-            for ip in ips:
-                ip.release()
+            # 预留的 IP 放回去给下一个容器用
+            if reserved is not None and not spec_ips:
+                for ip in ips:
+                    reserved.setdefault(ip.network.netspace, []).append(ip.id)
+                return
+            IP.release_many(ips)
 
         if not (cidrs or spec_ips):
             return True
@@ -64,7 +97,7 @@ class MacVLANIPAM(BaseIPAM):
         if spec_ips:
             ips = [n.acquire_specific_ip(ip) for n, ip in zip(networks, spec_ips)]
         else:
-            ips = [n.acquire_ip() for n in networks]
+            ips = [_take_ip(n) for n in networks]
 
         ips = [i for i in ips if i]
         ip_dict = {ip.vlan_address: ip for ip in ips}
@@ -85,8 +118,11 @@ class MacVLANIPAM(BaseIPAM):
         for r in rv:
             ip = ip_dict.get(r['ip'], None)
             if ip:
-                ip.set_vethname(r['veth'])
-                ip.assigned_to_container(container)
+                ip.vethname = r['veth']
+                container.ips.append(ip)
+        db.session.add(container)
+        db.session.commit()
+        self.refresh_ip_cache(container_id)
         return True
 
     def reallocate_ips(self, container_id):
@@ -101,18 +137,26 @@ class MacVLANIPAM(BaseIPAM):
         cidrs = [ip.network.netspace for ip in ips]
         spec_ips = [ip.address for ip in ips]
 
-        for ip in ips:
-            ip.release()
+        IP.release_many(ips)
+        self.invalidate_ip_cache(container_id)
 
         return self.allocate_ips(cidrs, container_id, spec_ips)
 
-    def get_ip_by_container(self, container_id):
+    def load_ip_by_container(self, container_id):
+        return self.load_ips_for_containers([container_id])[container_id]
+
+    def load_ips_for_containers(self, container_ids):
+        """one query for all containers"""
         from eru.models.container import Container
 
-        container = Container.get_by_container_id(container_id)
-        if not container:
-            return []
-        return [WrappedIP.from_macvlan(i) for i in container.ips.all()]
+        result = {cid: [] for cid in container_ids}
+        rows = db.session.query(IP, Container.container_id).\
+                join(Container, IP.container_id == Container.id).\
+                filter(Container.container_id.in_(container_ids)).\
+                order_by(IP.id).all()
+        for ip, cid in rows:
+            result[cid].append(WrappedIP.from_macvlan(ip))
+        return result
 
     def release_ip_by_container(self, container_id):
         from eru.models.container import Container
@@ -121,9 +165,8 @@ class MacVLANIPAM(BaseIPAM):
         if not container:
             return
 
-        ips = IP.get_by_container(container.id)
-        for ip in ips:
-            ip.release()
+        IP.release_many(IP.get_by_container(container.id))
+        self.invalidate_ip_cache(container_id)
 
     def add_eip(self, *eips):
         eips = [IPAddress(eip) for eip in eips]
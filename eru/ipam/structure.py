@@ -39,6 +39,12 @@ class WrappedIP(Jsonized):
         vlan_address = '%s/%s' % (ip, hostmask)
         return cls(0, ip.value, '', 0, container_id, str(ip), vlan_address, ip)
 
+    @classmethod
+    def from_dict(cls, d):
+        """rebuild from to_dict result, raw is just the IPAddress"""
+        return cls(d['id'], d['ipnum'], d['vethname'], d['network_id'],
+                d['container_id'], d['address'], d['vlan_address'], IPAddress(d['address']))
+
     def to_dict(self):
         return {
             'id': self.id,
@@ -75,9 +81,11 @@ class WrappedNetwork(Jsonized):
         return getattr(self._raw, name)
 
     @classmethod
-    def from_macvlan(cls, network):
+    def from_macvlan(cls, network, pool_size=None):
+        if pool_size is None:
+            pool_size = network.pool_size
         return cls(network.id, network.name, network.netspace, network.netspace,
-                network.gateway_count, network.pool_size, network.used_count,
+                network.gateway_count, pool_size, network.count_used(pool_size),
                 network)
 
     @classmethod
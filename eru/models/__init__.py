@@ -1,8 +1,8 @@
 # encoding: UTF-8
 
-from flask.ext.sqlalchemy import SQLAlchemy
+from eru.models.replica import RoutingSQLAlchemy
 
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 
 from eru.models.base import Base
 from eru.models.host import Core, Host
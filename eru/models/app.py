@@ -7,7 +7,7 @@ from sqlalchemy import event
 from sqlalchemy import DDL
 
 from eru.models import db
-from eru.models.base import Base
+from eru.models.base import Base, paginate
 from eru.models.image import Image
 from eru.models.appconfig import AppConfig, ResourceConfig
 
@@ -60,19 +60,13 @@ class Version(Base):
     def user_id(self):
         return self.app.user_id
 
-    def list_containers(self, start=0, limit=20):
+    def list_containers(self, start=0, limit=20, before=None):
         from .container import Container
-        q = self.containers.order_by(Container.id.desc()).offset(start)
-        if limit is not None:
-            q = q.limit(limit)
-        return q.all()
+        return paginate(self.containers, Container.id, start, limit, before)
 
-    def list_tasks(self, start=0, limit=20):
+    def list_tasks(self, start=0, limit=20, before=None):
         from .task import Task
-        q = self.tasks.order_by(Task.id.desc()).offset(start)
-        if limit is not None:
-            q = q.limit(limit)
-        return q.all()
+        return paginate(self.tasks, Task.id, start, limit, before)
 
     def get_resource_config(self, env='prod'):
         return ResourceConfig.get_by_name_and_env(self.name, env)
@@ -146,25 +140,16 @@ class App(Base):
     def list_resource_config(self):
         return ResourceConfig.list_env(self.name)
 
-    def list_versions(self, start=0, limit=20):
-        q = self.versions.order_by(Version.id.desc()).offset(start)
-        if limit is not None:
-            q = q.limit(limit)
-        return q.all()
+    def list_versions(self, start=0, limit=20, before=None):
+        return paginate(self.versions, Version.id, start, limit, before)
 
-    def list_containers(self, start=0, limit=20):
+    def list_containers(self, start=0, limit=20, before=None):
         from .container import Container
-        q = self.containers.order_by(Container.id.desc()).offset(start)
-        if limit is not None:
-            q = q.limit(limit)
-        return q.all()
+        return paginate(self.containers, Container.id, start, limit, before)
 
-    def list_tasks(self, start=0, limit=20):
+    def list_tasks(self, start=0, limit=20, before=None):
         from .task import Task
-        q = self.tasks.order_by(Task.id.desc()).offset(start)
-        if limit is not None:
-            q = q.limit(limit)
-        return q.all()
+        return paginate(self.tasks, Task.id, start, limit, before)
 
     def list_images(self, start=0, limit=20):
         from .image import Image
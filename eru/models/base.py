@@ -33,6 +33,22 @@ class Base(Jsonized, db.Model):
         return '{0}({1})'.format(self.__class__.__name__, attrs)
 
 
+def paginate(query, column, start=0, limit=20, before=None):
+    """
+    按 column 倒序分页.
+    给了 before 就用 keyset 分页, 直接从索引上 column < before 的位置开始取,
+    不用像 offset 那样把前面的行都扫一遍再扔掉.
+    """
+    query = query.order_by(column.desc())
+    if before is not None:
+        query = query.filter(column < before)
+    else:
+        query = query.offset(start)
+    if limit is not None:
+        query = query.limit(limit)
+    return query.all()
+
+
 _missing = object()
 
 
@@ -160,15 +160,17 @@ class Container(Base, PropsMixin):
         ports = entry.get('ports', [])
         return [int(p.split('/')[0]) for p in ports]
 
-    def get_ips(self):
+    def get_ips(self, ips=None):
+        """ips 是预先批量取好的 WrappedIP, 不给就自己去 ipam 拿"""
         if self.network_mode == 'host':
             return [self.host.ip]
-        ips = ipam.get_ip_by_container(self.container_id)
+        if ips is None:
+            ips = ipam.get_ip_by_container(self.container_id)
         return [str(ip) for ip in ips]
 
-    def get_backends(self):
+    def get_backends(self, ips=None):
         """daemon的话是个空列表"""
-        ips = self.get_ips()
+        ips = self.get_ips(ips)
         ports = self.get_ports()
         return ['{0}:{1}'.format(ip, port) for ip, port in itertools.product(ips, ports)]
 
@@ -202,7 +204,7 @@ class Container(Base, PropsMixin):
         self.publish_status('down')
 
         remove_container_backends(self)
-        publish_to_service_discovery(self.appname)
+        publish_to_service_discovery(self.appname, immediate=True)
 
     def cure(self):
         self.is_alive = 1
@@ -245,7 +247,7 @@ class Container(Base, PropsMixin):
             },
             version=self.short_sha,
             networks=ips,
-            backends=self.get_backends(),
+            backends=self.get_backends(ips),
             appname=self.appname,
             eip=self.eip,
             in_removal=self.in_removal,
@@ -1,19 +1,25 @@
 # coding:utf-8
+import time
+
 import sqlalchemy.exc
 from netaddr import IPAddress
 
 from eru.agent import get_agent
+from eru.config import DOCKER_IMAGE_CACHE_TTL, ERU_BUILD_TIMEOUT
 from eru.ipam import ipam
-from eru.connection import rds
-from eru.publish import (add_container_backends,
-        remove_container_backends, publish_to_service_discovery)
+from eru.connection import rds, get_docker_client
+from eru.publish import (add_containers_backends,
+        remove_containers_backends, publish_to_service_discovery)
 from eru.models import db
-from eru.models.base import Base, PropsMixin, PropsItem
+from eru.models.base import Base, PropsMixin, PropsItem, paginate
 from eru.utils.decorator import redis_lock
 
 
-_pipeline = rds.pipeline()
 _HOST_EIP_KEY = 'eru:host:%s:eip'
+_HOST_IMAGES_KEY = 'eru:host:%s:images'
+_HOST_BUILDS_KEY = 'eru:host:%s:builds'
+# 标记镜像列表是从 docker 完整拉过一次的, 空的宿主机也要有这个
+_IMAGES_LOADED = ''
 
 
 class Core(object):
@@ -46,6 +52,9 @@ def _ip_address_filter(values):
 
 class Host(Base, PropsMixin):
     __tablename__ = 'host'
+    __table_args__ = (
+        db.Index('ix_host_pod_public_alive', 'pod_id', 'is_public', 'is_alive'),
+    )
 
     addr = db.Column(db.CHAR(30), nullable=False, unique=True)
     name = db.Column(db.CHAR(30), nullable=False)
@@ -124,8 +133,8 @@ class Host(Base, PropsMixin):
         return cls.query.filter_by(name=name).first()
 
     @classmethod
-    def get_random_public_host(cls):
-        return cls.query.filter(cls.is_public == True, cls.is_alive == True, cls.ncore > 0).limit(1).first()
+    def get_public_hosts(cls):
+        return cls.query.filter(cls.is_public == True, cls.is_alive == True, cls.ncore > 0).all()
 
     @property
     def ip(self):
@@ -135,6 +144,14 @@ class Host(Base, PropsMixin):
     def _cores_key(self):
         return 'eru:host:%s:cores' % self.id
 
+    @property
+    def _images_key(self):
+        return _HOST_IMAGES_KEY % self.id
+
+    @property
+    def _builds_key(self):
+        return _HOST_BUILDS_KEY % self.id
+
     @property
     def cores(self):
         r = rds.zrange(self._cores_key, 0, -1, withscores=True, score_cast_func=int)
@@ -148,11 +165,9 @@ class Host(Base, PropsMixin):
     def core_share(self):
         return self.pod.core_share
 
-    def list_containers(self, start=0, limit=20):
-        q = self.containers.offset(start)
-        if limit is not None:
-            q = q.limit(limit)
-        return q.all()
+    def list_containers(self, start=0, limit=20, before=None):
+        from .container import Container
+        return paginate(self.containers, Container.id, start, limit, before)
 
     def list_vlans(self, start=0, limit=20):
         return self.vlans[start:start+limit]
@@ -245,50 +260,121 @@ class Host(Base, PropsMixin):
         db.session.commit()
 
     def occupy_cores(self, cores, nshare):
+        # 每次用新的 pipeline, 共用一个的话并发的时候命令会混在一起
+        pipe = rds.pipeline()
         slice_count = self.pod.core_share
         for core in cores.get('full', []):
-            _pipeline.zincrby(self._cores_key, core.label, -slice_count)
+            pipe.zincrby(self._cores_key, core.label, -slice_count)
         for core in cores.get('part', []):
-            _pipeline.zincrby(self._cores_key, core.label, -nshare)
-        _pipeline.execute()
+            pipe.zincrby(self._cores_key, core.label, -nshare)
+        pipe.execute()
 
     def release_cores(self, cores, nshare):
+        pipe = rds.pipeline()
         slice_count = self.pod.core_share
         for core in cores.get('full', []):
-            _pipeline.zincrby(self._cores_key, core.label, slice_count)
+            pipe.zincrby(self._cores_key, core.label, slice_count)
         for core in cores.get('part', []):
-            _pipeline.zincrby(self._cores_key, core.label, nshare)
-        _pipeline.execute()
+            pipe.zincrby(self._cores_key, core.label, nshare)
+        pipe.execute()
+
+    def refresh_images(self, tags=None):
+        """
+        重建这台机器的镜像列表, 不给 tags 的话问 docker 要.
+        列表 DOCKER_IMAGE_CACHE_TTL 秒之后过期, 下次用的时候再重建.
+        """
+        if tags is None:
+            client = get_docker_client(self.addr)
+            tags = [t for i in client.images() for t in (i.get('RepoTags') or [])
+                    if t != '<none>:<none>']
+
+        pipe = rds.pipeline()
+        pipe.delete(self._images_key)
+        pipe.sadd(self._images_key, _IMAGES_LOADED, *tags)
+        pipe.expire(self._images_key, DOCKER_IMAGE_CACHE_TTL)
+        pipe.execute()
 
-    def kill(self):
-        self.is_alive = False
-        appnames = set()
-        for c in self.containers.all():
-            c.is_alive = 0
-            db.session.add(c)
+    @classmethod
+    def get_ids_with_image(cls, hosts, tag):
+        """只看 redis 里的镜像列表, 不会去问 docker, 给调度用"""
+        pipe = rds.pipeline(transaction=False)
+        for host in hosts:
+            pipe.sismember(host._images_key, tag)
+        return {h.id for h, r in zip(hosts, pipe.execute()) if r}
+
+    def has_image(self, tag):
+        pipe = rds.pipeline(transaction=False)
+        pipe.sismember(self._images_key, _IMAGES_LOADED)
+        pipe.sismember(self._images_key, tag)
+        loaded, exists = pipe.execute()
+        if loaded:
+            return bool(exists)
+
+        self.refresh_images()
+        return bool(rds.sismember(self._images_key, tag))
+
+    def add_images(self, *tags):
+        """
+        pull/build 完了之后记下来.
+        列表已经过期的话这里会建出一个没有标记的 set, has_image 会当它没加载过,
+        所以也给它一个过期时间就好.
+        """
+        if not tags:
+            return
+        pipe = rds.pipeline()
+        pipe.sadd(self._images_key, *tags)
+        pipe.ttl(self._images_key)
+        _, ttl = pipe.execute()
+        if ttl is None or ttl < 0:
+            rds.expire(self._images_key, DOCKER_IMAGE_CACHE_TTL)
 
-            remove_container_backends(c)
-            appnames.add(c.appname)
+    def remove_images(self, *tags):
+        if tags:
+            rds.srem(self._images_key, *tags)
 
+    def add_build(self, task_id):
+        """记下这台机器上在跑的 build, 分数是开始时间"""
+        rds.zadd(self._builds_key, **{str(task_id): time.time()})
+
+    def remove_build(self, task_id):
+        rds.zrem(self._builds_key, str(task_id))
+
+    @classmethod
+    def get_build_loads(cls, hosts):
+        """
+        每台机器上在跑的 build 数, {host_id: count}.
+        超过 ERU_BUILD_TIMEOUT 的当作 worker 挂了没清掉, 不算.
+        """
+        pipe = rds.pipeline(transaction=False)
+        deadline = time.time() - ERU_BUILD_TIMEOUT
+        for host in hosts:
+            pipe.zremrangebyscore(host._builds_key, 0, deadline)
+            pipe.zcard(host._builds_key)
+        counts = pipe.execute()[1::2]
+        return {h.id: c for h, c in zip(hosts, counts)}
+
+    def kill(self):
+        """先把流量摘掉, 再一条 UPDATE 改掉所有容器的状态"""
+        containers = self.containers.all()
+        appnames = {c.appname for c in containers}
+        remove_containers_backends(containers)
+
+        self.is_alive = False
         db.session.add(self)
+        self.containers.update({'is_alive': 0}, synchronize_session=False)
         db.session.commit()
 
-        publish_to_service_discovery(*appnames)
+        publish_to_service_discovery(*appnames, immediate=True)
 
     def cure(self):
         self.is_alive = True
-        appnames = set()
-        for c in self.containers.all():
-            c.is_alive = 1
-            db.session.add(c)
-
-            add_container_backends(c)
-            appnames.add(c.appname)
-
         db.session.add(self)
+        self.containers.update({'is_alive': 1}, synchronize_session=False)
         db.session.commit()
 
-        publish_to_service_discovery(*appnames)
+        containers = self.containers.all()
+        add_containers_backends(containers)
+        publish_to_service_discovery(*{c.appname for c in containers})
 
     def bind_eip(self, eip=None):
         eip = ipam.get_eip(eip)
@@ -0,0 +1,211 @@
+# coding: utf-8
+"""
+network 下可用的容器 IP 池.
+
+set: 每个可用 IP 是 redis set 里的一个成员, 大网段很占内存.
+bitmap: 一个网段一个 bitmap, 第 n 位对应 network.first + n, 1 表示被占用.
+"""
+
+import itertools
+
+import more_itertools
+
+from eru.connection import rds
+
+
+class SetIPPool(object):
+
+    name = 'set'
+
+    def __init__(self, network):
+        self.network = network
+        self.key = 'eru:network:%s:ips' % network.name
+
+    def init(self, ipnums):
+        rds.delete(self.key)
+        # 一次写500个吧
+        for chunk in more_itertools.chunked(ipnums, 500):
+            rds.sadd(self.key, *chunk)
+
+    def pop(self):
+        ipnum = rds.spop(self.key)
+        return ipnum and int(ipnum) or None
+
+    def pop_many(self, count):
+        pipe = rds.pipeline()
+        for _ in xrange(count):
+            pipe.spop(self.key)
+        return [int(i) for i in pipe.execute() if i]
+
+    def take(self, ipnum):
+        return rds.srem(self.key, ipnum) == 1
+
+    def put(self, ipnum):
+        rds.sadd(self.key, ipnum)
+
+    def put_many(self, ipnums):
+        for chunk in more_itertools.chunked(ipnums, 500):
+            rds.sadd(self.key, *chunk)
+
+    def take_many(self, ipnums):
+        for chunk in more_itertools.chunked(ipnums, 500):
+            rds.srem(self.key, *chunk)
+
+    def contains(self, ipnum):
+        return rds.sismember(self.key, ipnum)
+
+    def contains_many(self, ipnums):
+        pipe = rds.pipeline(transaction=False)
+        for ipnum in ipnums:
+            pipe.sismember(self.key, ipnum)
+        return [bool(r) for r in pipe.execute()]
+
+    def size(self):
+        return rds.scard(self.key)
+
+    def queue_size(self, pipe):
+        """往 pipe 里塞查询大小的命令, 返回结果怎么算出大小"""
+        pipe.scard(self.key)
+        return 1, lambda scard: scard
+
+    def ipnums(self):
+        return [int(i) for i in rds.sscan_iter(self.key, count=1000)]
+
+    def clear(self):
+        rds.delete(self.key)
+
+
+class BitmapIPPool(object):
+
+    name = 'bitmap'
+
+    def __init__(self, network):
+        self.network = network
+        self.key = 'eru:network:%s:bitmap' % network.name
+        net = network.network
+        self.first = net.first
+        self.length = net.size
+
+    def _offset(self, ipnum):
+        offset = int(ipnum) - self.first
+        if 0 <= offset < self.length:
+            return offset
+        return None
+
+    def init(self, ipnums):
+        """
+        在本地拼好整个 bitmap 再一次 SET 上去, 大网段也只有一条命令.
+        网段内先都标成已占用, 再把可用的 ipnums 清零, 结尾补齐的位保持 0.
+        """
+        full, rest = divmod(self.length, 8)
+        bitmap = bytearray('\xff' * full)
+        if rest:
+            bitmap.append((0xff << (8 - rest)) & 0xff)
+        for ipnum in ipnums:
+            offset = self._offset(ipnum)
+            if offset is not None:
+                bitmap[offset / 8] &= ~(0x80 >> (offset % 8)) & 0xff
+        rds.set(self.key, str(bitmap))
+
+    def _setbits(self, ipnums, bit):
+        for chunk in more_itertools.chunked(ipnums, 500):
+            pipe = rds.pipeline()
+            for ipnum in chunk:
+                offset = self._offset(ipnum)
+                if offset is not None:
+                    pipe.setbit(self.key, offset, bit)
+            pipe.execute()
+
+    def put_many(self, ipnums):
+        self._setbits(ipnums, 0)
+
+    def take_many(self, ipnums):
+        self._setbits(ipnums, 1)
+
+    def _free_offsets(self):
+        bitmap = rds.get(self.key) or ''
+        for i, byte in enumerate(bytearray(bitmap)):
+            if byte == 0xff:
+                continue
+            for bit in xrange(8):
+                offset = i * 8 + bit
+                if offset < self.length and not byte & (0x80 >> bit):
+                    yield offset
+
+    def pop(self):
+        """调用方要持有 network 的锁, bitpos 和 setbit 之间不是原子的"""
+        offset = rds.bitpos(self.key, 0)
+        if offset < 0 or offset >= self.length:
+            return None
+        rds.setbit(self.key, offset, 1)
+        return self.first + offset
+
+    def pop_many(self, count):
+        """一次读出整个 bitmap 挑空位, 同样要持有 network 的锁"""
+        offsets = list(itertools.islice(self._free_offsets(), count))
+        pipe = rds.pipeline()
+        for offset in offsets:
+            pipe.setbit(self.key, offset, 1)
+        pipe.execute()
+        return [self.first + offset for offset in offsets]
+
+    def take(self, ipnum):
+        offset = self._offset(ipnum)
+        if offset is None:
+            return False
+        return rds.setbit(self.key, offset, 1) == 0
+
+    def put(self, ipnum):
+        offset = self._offset(ipnum)
+        if offset is not None:
+            rds.setbit(self.key, offset, 0)
+
+    def contains(self, ipnum):
+        offset = self._offset(ipnum)
+        if offset is None:
+            return False
+        return rds.getbit(self.key, offset) == 0
+
+    def contains_many(self, ipnums):
+        """一次 GETRANGE 拿到覆盖这些地址的那一段 bitmap"""
+        offsets = [self._offset(ipnum) for ipnum in ipnums]
+        valid = [o for o in offsets if o is not None]
+        if not valid:
+            return [False] * len(offsets)
+        lo, hi = min(valid) / 8, max(valid) / 8
+        chunk = bytearray(rds.getrange(self.key, lo, hi) or '')
+
+        def _free(offset):
+            if offset is None:
+                return False
+            i = offset / 8 - lo
+            # getrange 超出长度的部分拿不到, 当成占用
+            return i < len(chunk) and not chunk[i] & (0x80 >> (offset % 8))
+        return [_free(o) for o in offsets]
+
+    def size(self):
+        pipe = rds.pipeline(transaction=False)
+        _, parse = self.queue_size(pipe)
+        return parse(*pipe.execute())
+
+    def queue_size(self, pipe):
+        # 结尾补齐的位都是 0, 不会被 bitcount 算进去
+        pipe.exists(self.key)
+        pipe.bitcount(self.key)
+        return 2, lambda exists, used: self.length - used if exists else 0
+
+    def ipnums(self):
+        return [self.first + offset for offset in self._free_offsets()]
+
+    def clear(self):
+        rds.delete(self.key)
+
+
+IP_POOLS = {
+    SetIPPool.name: SetIPPool,
+    BitmapIPPool.name: BitmapIPPool,
+}
+
+
+def get_ip_pool(network):
+    return IP_POOLS.get(network.allocator or SetIPPool.name, SetIPPool)(network)
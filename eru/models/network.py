@@ -1,10 +1,11 @@
 # coding: utf-8
-import more_itertools
 import sqlalchemy.exc
 from netaddr import IPAddress, IPNetwork, AddrFormatError
 
+from eru.config import NETWORK_IP_ALLOCATOR
 from eru.models import db
 from eru.models.base import Base
+from eru.models.ippool import get_ip_pool, IP_POOLS
 from eru.connection import rds
 from eru.utils.decorator import redis_lock
 
@@ -55,6 +56,25 @@ class IP(Base, IPMixin):
         db.session.commit()
         return ip
 
+    @classmethod
+    def create_many(cls, ipnums, network):
+        ips = [cls(ipnum, network) for ipnum in ipnums]
+        db.session.add_all(ips)
+        db.session.commit()
+        return ips
+
+    @classmethod
+    def release_many(cls, ips):
+        """删掉记录之后再把地址还回去, 同一个 network 的一起还"""
+        ipnums = {}
+        for ip in ips:
+            ipnums.setdefault(ip.network, []).append(ip.ipnum)
+            db.session.delete(ip)
+        db.session.commit()
+
+        for network, nums in ipnums.iteritems():
+            network.release_ips(nums)
+
     @classmethod
     def get_by_value(cls, value):
         return cls.query.filter_by(ipnum=value).first()
@@ -82,9 +102,11 @@ class IP(Base, IPMixin):
         return True
 
     def release(self):
-        self.network.release_ip(self)
+        # 先删记录再还地址, 不然地址可能在记录删掉之前就被别人拿走了
+        network, ipnum = self.network, self.ipnum
         db.session.delete(self)
         db.session.commit()
+        network.release_ip(ipnum)
 
     def to_dict(self):
         d = super(IP, self).to_dict()
@@ -150,20 +172,25 @@ class Network(Base):
     name = db.Column(db.CHAR(40), unique=True, nullable=False)
     netspace = db.Column(db.CHAR(40), nullable=False, default='', index=True)
     gateway_count = db.Column(db.Integer, nullable=False, default=100)
+    allocator = db.Column(db.CHAR(10), nullable=False, default='set')
 
     ips = db.relationship('IP', backref='network', lazy='dynamic', cascade='save-update, merge, delete')
     gates = db.relationship('VLanGateway', backref='network', lazy='dynamic', cascade='save-update, merge, delete')
 
-    def __init__(self, name, netspace, gateway_count):
+    def __init__(self, name, netspace, gateway_count, allocator):
         self.name = name
         self.netspace = netspace
         self.gateway_count = gateway_count
+        self.allocator = allocator
 
     @classmethod
-    def create(cls, name, netspace, gateway_count=100):
+    def create(cls, name, netspace, gateway_count=100, allocator=None):
         """create network and store ips(int) under this network in redis"""
+        allocator = allocator or NETWORK_IP_ALLOCATOR
+        if allocator not in IP_POOLS:
+            return None
         try:
-            n = cls(name, netspace, gateway_count)
+            n = cls(name, netspace, gateway_count, allocator)
             db.session.add(n)
             db.session.commit()
 
@@ -171,10 +198,8 @@ class Network(Base):
             network = n.network
             base = network.first
 
-            # 一次写500个吧
             # 写容器可用IP
-            for ipnums in more_itertools.chunked(xrange(base+gateway_count, base+network.size), 500):
-                rds.sadd(n.storekey, *ipnums)
+            n.ip_pool.init(xrange(base+gateway_count, base+network.size))
 
             # 写宿主机可用IP
             rds.sadd(n.gatekey, *range(base, base+gateway_count))
@@ -194,13 +219,21 @@ class Network(Base):
     def get_by_name(cls, name):
         return cls.query.filter_by(name=name).first()
 
+    @classmethod
+    def get_pool_sizes(cls, networks):
+        """pool size of each network, in one redis round trip"""
+        pipe = rds.pipeline(transaction=False)
+        parsers = [n.ip_pool.queue_size(pipe) for n in networks]
+        replies = iter(pipe.execute())
+        return [parse(*[next(replies) for _ in xrange(count)]) for count, parse in parsers]
+
     @classmethod
     def get_by_netspace(cls, netspace):
         return cls.query.filter_by(netspace=netspace).first()
 
     @property
     def storekey(self):
-        return 'eru:network:%s:ips' % self.name
+        return self.ip_pool.key
 
     @property
     def gatekey(self):
@@ -214,9 +247,13 @@ class Network(Base):
     def network(self):
         return IPNetwork(self.netspace)
 
+    @property
+    def ip_pool(self):
+        return get_ip_pool(self)
+
     @property
     def pool_size(self):
-        return rds.scard(self.storekey)
+        return self.ip_pool.size()
 
     @property
     def gate_pool_size(self):
@@ -224,7 +261,10 @@ class Network(Base):
 
     @property
     def used_count(self):
-        return (self.network.size - self.gateway_count) - self.pool_size
+        return self.count_used(self.pool_size)
+
+    def count_used(self, pool_size):
+        return (self.network.size - self.gateway_count) - pool_size
 
     @property
     def used_gate_count(self):
@@ -233,22 +273,27 @@ class Network(Base):
     def __contains__(self, ip):
         return self.contains_ip(ip)
 
-    @redis_lock('net:acquire_ip:{self.id}')
     def contains_ip(self, ip):
-        """ip is unicode or IPAddress object"""
+        """ip is unicode or IPAddress object, a single read, no lock needed"""
         if isinstance(ip, basestring):
             try:
                 ip = IPAddress(ip)
             except AddrFormatError:
                 return False
-        return rds.sismember(self.storekey, ip.value)
+        return self.ip_pool.contains(ip.value)
 
     @redis_lock('net:acquire_ip:{self.id}')
     def acquire_ip(self):
         """take an IP from network, return an IP object"""
-        ipnum = rds.spop(self.storekey)
+        ipnum = self.ip_pool.pop()
         return ipnum and IP.create(ipnum, self) or None
 
+    @redis_lock('net:acquire_ip:{self.id}')
+    def acquire_ips(self, count):
+        """take count IPs in one lock hold, may return less than count"""
+        ipnums = self.ip_pool.pop_many(count)
+        return ipnums and IP.create_many(ipnums, self) or []
+
     @redis_lock('net:acquire_ip:{self.id}')
     def acquire_specific_ip(self, ip_str):
         """take a specific IP from network"""
@@ -257,13 +302,16 @@ class Network(Base):
         except ValueError:
             return None
 
-        if rds.sismember(self.storekey, ip.value):
-            rds.srem(self.storekey, ip.value)
+        if self.ip_pool.take(ip.value):
             return IP.create(ip.value, self)
 
     @redis_lock('net:acquire_ip:{self.id}')
     def release_ip(self, ip):
-        rds.sadd(self.storekey, int(ip))
+        self.ip_pool.put(int(ip))
+
+    @redis_lock('net:acquire_ip:{self.id}')
+    def release_ips(self, ipnums):
+        self.ip_pool.put_many([int(i) for i in ipnums])
 
     @redis_lock('net:gateway_ip:{self.id}')
     def acquire_gateway_ip(self, host):
@@ -282,6 +330,73 @@ class Network(Base):
     def release_gateway(self, ip):
         rds.sadd(self.gatekey, int(ip))
 
+    def reconcile(self, chunk_size=1024):
+        """
+        diff ip/vlan_gateway tables against redis pools chunk by chunk,
+        and fix them online. returns how many addresses were wrong:
+        leaked: not used but not in pool either, put back to pool.
+        double_assigned: used but still in pool, taken out of pool.
+        """
+        report = dict.fromkeys(['leaked', 'double_assigned', 'gate_leaked', 'gate_double_assigned'], 0)
+        network = self.network
+        last = network.first + network.size
+        for start in xrange(network.first, last, chunk_size):
+            r = self._reconcile_chunk(start, min(start+chunk_size, last))
+            for k, v in r.iteritems():
+                report[k] += v
+        return report
+
+    @redis_lock('net:acquire_ip:{self.id}')
+    def _reconcile_chunk(self, start, end):
+        with rds.lock('net:gateway_ip:%s' % self.id):
+            # 拿到锁之后结束当前事务, 才能看到别人刚提交的记录
+            db.session.commit()
+
+            ipnums = range(start, end)
+            used = {i for i, in db.session.query(IP.ipnum).filter(
+                IP.network_id == self.id, IP.ipnum >= start, IP.ipnum < end)}
+            gate_used = {i for i, in db.session.query(VLanGateway.ipnum).filter(
+                VLanGateway.network_id == self.id, VLanGateway.ipnum >= start, VLanGateway.ipnum < end)}
+            pooled = self.ip_pool.contains_many(ipnums)
+
+            gate_end = self.network.first + self.gateway_count
+            gate_ipnums = [i for i in ipnums if i < gate_end]
+            pipe = rds.pipeline(transaction=False)
+            for ipnum in gate_ipnums:
+                pipe.sismember(self.gatekey, ipnum)
+            gated = dict(zip(gate_ipnums, pipe.execute()))
+
+            leaked, double, gate_leaked, gate_double = [], [], [], []
+            for ipnum, in_pool in zip(ipnums, pooled):
+                if ipnum in used:
+                    if in_pool:
+                        double.append(ipnum)
+                elif ipnum >= gate_end and not in_pool:
+                    leaked.append(ipnum)
+
+                if ipnum >= gate_end:
+                    continue
+                # 宿主机 IP 段里的地址也可能被 add_ip 挪给了容器
+                if ipnum in gate_used:
+                    if gated[ipnum]:
+                        gate_double.append(ipnum)
+                elif not (gated[ipnum] or in_pool or ipnum in used):
+                    gate_leaked.append(ipnum)
+
+            self.ip_pool.put_many(leaked)
+            self.ip_pool.take_many(double)
+            if gate_leaked:
+                rds.sadd(self.gatekey, *gate_leaked)
+            if gate_double:
+                rds.srem(self.gatekey, *gate_double)
+
+        return {
+            'leaked': len(leaked),
+            'double_assigned': len(double),
+            'gate_leaked': len(gate_leaked),
+            'gate_double_assigned': len(gate_double),
+        }
+
     def add_ip(self, ip):
         if isinstance(ip, basestring):
             try:
@@ -291,19 +406,22 @@ class Network(Base):
         ipnum = ip.value
         if rds.sismember(self.gatekey, ipnum):
             rds.srem(self.gatekey, ipnum)
-        rds.sadd(self.storekey, ipnum)
+        self.ip_pool.put(ipnum)
         return True
 
     def delete(self):
         IP.delete_by_network(self.id)
-        rds.delete(self.storekey, self.gatekey)
+        self.ip_pool.clear()
+        rds.delete(self.gatekey)
         db.session.delete(self)
         db.session.commit()
 
     def to_dict(self):
         d = super(Network, self).to_dict()
+        pool_size = self.pool_size
         d.update(
-            pool_size=self.pool_size,
-            used_count=self.used_count,
+            pool_size=pool_size,
+            used_count=self.count_used(pool_size),
+            allocator=self.allocator,
         )
         return d
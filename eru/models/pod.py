@@ -4,7 +4,7 @@ import random
 import sqlalchemy.exc
 
 from eru.models import db
-from eru.models.base import Base
+from eru.models.base import Base, paginate
 from eru.config import DEFAULT_CORE_SHARE, DEFAULT_MAX_SHARE_CORE
 
 
@@ -40,7 +40,22 @@ class Pod(Base):
         q = cls.query.offset(start)
         if limit is not None:
             q = q.limit(limit)
-        return q.all()
+        pods = q.all()
+
+        # 一次 group by 把这一页的 host 数都取出来, 省得 to_dict 每个 pod 再 count 一次
+        counts = cls.get_host_counts([p.id for p in pods])
+        for pod in pods:
+            pod._host_count = counts.get(pod.id, 0)
+        return pods
+
+    @classmethod
+    def get_host_counts(cls, pod_ids):
+        from .host import Host
+        if not pod_ids:
+            return {}
+        q = db.session.query(Host.pod_id, db.func.count(Host.id)).\
+                filter(Host.pod_id.in_(pod_ids)).group_by(Host.pod_id)
+        return dict(q.all())
 
     @classmethod
     def get_by_name(cls, name):
@@ -52,26 +67,37 @@ class Pod(Base):
         core_require = int(core_require * self.core_share)
         return core_require / self.core_share, core_require % self.core_share
 
-    def list_hosts(self, start=0, limit=20, show_all=False):
+    def list_hosts(self, start=0, limit=20, show_all=False, before=None):
         from .host import Host
         q = self.hosts
         if not show_all:
             q = q.filter_by(is_alive=True)
-        q = q.order_by(Host.id.desc()).offset(start)
-        if limit is not None:
-            q = q.limit(limit)
-        return q.all()
+        return paginate(q, Host.id, start, limit, before)
 
     def get_free_public_hosts(self, limit):
-        hosts = [h for h in self.hosts if h.is_public and h.is_alive]
-        random.shuffle(hosts)
-        return hosts[:limit] if limit is not None else hosts
+        """先只取 id 洗牌, 再把选中的 host 整行捞出来"""
+        from .host import Host
+        q = db.session.query(Host.id).filter(Host.pod_id == self.id,
+                Host.is_public == True, Host.is_alive == True)
+        ids = [id for id, in q.all()]
+        random.shuffle(ids)
+        if limit is not None:
+            ids = ids[:limit]
+        if not ids:
+            return []
+
+        hosts = {h.id: h for h in Host.query.filter(Host.id.in_(ids)).all()}
+        return [hosts[id] for id in ids if id in hosts]
 
     def get_private_hosts(self):
-        return [h for h in self.hosts if not h.is_public and h.is_alive]
+        return self.hosts.filter_by(is_public=False, is_alive=True).all()
 
     def host_count(self):
-        return self.hosts.count()
+        count = getattr(self, '_host_count', None)
+        if count is not None:
+            return count
+        from .host import Host
+        return db.session.query(db.func.count(Host.id)).filter(Host.pod_id == self.id).scalar()
 
     def to_dict(self):
         d = super(Pod, self).to_dict()
@@ -0,0 +1,56 @@
+# coding: utf-8
+
+import random
+
+from flask import g, has_request_context
+from flask.ext.sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event
+
+
+class ReplicaRoutingSession(SignallingSession):
+    """
+    请求标记了 use_replica 的时候查询走从库.
+    session 里只要写过东西, 后面的查询就都回主库, 保证读得到自己写的.
+    """
+
+    def __init__(self, db, **options):
+        self._db = db
+        self._replica = None
+        self.written = False
+        super(ReplicaRoutingSession, self).__init__(db, **options)
+
+    def _want_replica(self):
+        if self.written or self._flushing:
+            return False
+        return has_request_context() and getattr(g, 'use_replica', False)
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._want_replica():
+            if self._replica is None:
+                self._replica = self._db.get_replica_engine(self.app)
+            if self._replica is not None:
+                return self._replica
+        return super(ReplicaRoutingSession, self).get_bind(mapper, clause)
+
+
+@event.listens_for(ReplicaRoutingSession, 'after_flush')
+def _mark_written(session, flush_context):
+    session.written = True
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def create_session(self, options):
+        return ReplicaRoutingSession(self, **options)
+
+    def get_replica_engine(self, app=None):
+        """随便挑一个从库, 没配置从库就是 None"""
+        app = self.get_app(app)
+        binds = app.config.get('SQLALCHEMY_REPLICA_BINDS')
+        if not binds:
+            return None
+        return self.get_engine(app, bind=random.choice(binds))
+
+    def session_written(self):
+        registry = self.session.registry
+        return registry.has() and registry().written
@@ -1,11 +1,16 @@
 # coding: utf-8
 
 import json
+import time
 import logging
 import functools
-from etcd import EtcdException
+from etcd import EtcdException, EtcdKeyNotFound
 
+from eru.config import (SERVICE_DISCOVERY_FULL_INTERVAL, SERVICE_DISCOVERY_PUBLISH_WINDOW,
+                        SERVICE_DISCOVERY_PUBLISH_MAX_DELAY, SERVICE_DISCOVERY_LAYOUT,
+                        SERVICE_DISCOVERY_FEED_SIZE, SERVICE_DISCOVERY_LEGACY_DOCUMENT)
 from eru.connection import rds, etcd
+from eru.ipam import ipam
 from eru.models.app import App
 
 
@@ -14,6 +19,45 @@ _log = logging.getLogger(__name__)
 _APP_BACKENDS_KEY = 'eru:app:%s:backends'
 _APP_ENTRYPOINT_BACKENDS_KEY = 'eru:app:%s:entrypoint:%s:backends'
 _APP_DISCOVERY_KEY = 'eru:discovery:published'
+_APP_PENDING_KEY = 'eru:discovery:%s:pending'
+_APP_FULL_KEY = 'eru:discovery:%s:full'
+_APP_MEMBERS_KEY = 'eru:discovery:%s:members'
+_APP_PUBLISH_LOCK = 'eru:discovery:%s:lock'
+_APP_PUBLISH_FIRST_KEY = 'eru:discovery:%s:window:first'
+_APP_PUBLISH_LAST_KEY = 'eru:discovery:%s:window:last'
+_APP_PUBLISH_SCHEDULED_KEY = 'eru:discovery:%s:window:scheduled'
+_FEED_VERSION_KEY = 'eru:discovery:feed:version'
+_FEED_KEY = 'eru:discovery:feed'
+
+# 版本号自增, 带上版本号写进 zset, 只留最近的 ARGV[2] 条.
+# ARGV[1] 是不带版本号的 json object, 直接拼字符串, 免得 cjson 把空列表变成 {}
+_FEED_APPEND_LUA = '''
+local v = redis.call('INCR', KEYS[1])
+local change = '{"version": ' .. v .. ', ' .. string.sub(ARGV[1], 2)
+redis.call('ZADD', KEYS[2], v, change)
+redis.call('ZREMRANGEBYRANK', KEYS[2], 0, -tonumber(ARGV[2]) - 1)
+return v
+'''
+# KEYS[1] 是 etcd 里已经算上了的容器, 有这个 set 的话增删一个容器
+# 只有 set 真的变了才排增量, 同一个容器删两次不会删掉别人共用的地址.
+# 还没全量重建过(没有这个 set)就照旧排, 等下次全量修正.
+_PENDING_PUSH_LUA = '''
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    local changed
+    if ARGV[1] == 'add' then
+        changed = redis.call('SADD', KEYS[1], ARGV[2])
+    else
+        changed = redis.call('SREM', KEYS[1], ARGV[2])
+    end
+    if changed == 0 then
+        return 0
+    end
+end
+redis.call('RPUSH', KEYS[2], ARGV[3])
+redis.call('EXPIRE', KEYS[2], ARGV[4])
+return 1
+'''
+_scripts = {}
 _AGENT_CONTAINER_KEY = 'eru:agent:%s:containers:meta'
 _NO_REPORT_KEY = 'eru:agent:%s:container:flag'
 
@@ -38,6 +82,23 @@ def squash_dict(d):
     return r
 
 
+def apply_delta(entrypoint, delta):
+    """
+    entrypoint 是 {'addresses': [...], 'backends': [...]}, 原地修改.
+    按可重复的列表算: host 网络的容器报的都是 host.ip, 同一个地址可能出现好几次,
+    删一个容器只去掉一份, 结果和 collect_app 全量算出来的一样.
+    """
+    for field in ('addresses', 'backends'):
+        current = list(entrypoint.get(field, []))
+        if delta['op'] == 'add':
+            current.extend(delta[field])
+        else:
+            for item in delta[field]:
+                if item in current:
+                    current.remove(item)
+        entrypoint[field] = current
+
+
 class EtcdPublisher(object):
     """
     完整路径是 /eru/service-nodes/:appname
@@ -56,67 +117,194 @@ class EtcdPublisher(object):
         return etcd.write(path, value)
 
     def get_app(self, appname):
-        path = self.APP_PATH % appname
-        r = self.read(path)
+        return self._read_document(appname)
+
+    def _read_document(self, appname):
+        r = self.read(self.APP_PATH % appname)
         return r and json.loads(r.value) or None
 
     def add_container(self, container):
-        app = self.get_app(container.appname) or {}
-
-        addresses = container.get_ips()
-        backends = container.get_backends()
-
-        current_addresses = app.get(container.short_sha, {}).get(container.entrypoint, {}).get('addresses', [])
-        current_backends = app.get(container.short_sha, {}).get(container.entrypoint, {}).get('backends', [])
+        self.apply_deltas(container.appname, [container_delta(container, 'add')])
 
-        new_addresses = list(set(current_addresses) | set(addresses))
-        new_backends = list(set(current_backends) | set(backends))
-
-        entrypoint = app.setdefault(container.short_sha, {}).setdefault(container.entrypoint, {})
-        entrypoint['addresses'] = new_addresses
-        entrypoint['backends'] = new_backends
+    def remove_container(self, container):
+        self.apply_deltas(container.appname, [container_delta(container, 'remove')])
 
-        path = self.APP_PATH % container.appname
-        self.write(path, json.dumps(squash_dict(app)))
+    def apply_deltas(self, appname, deltas):
+        """在 etcd 里现有的数据上按顺序应用增量, 写成功返回 True"""
+        app = self._read_document(appname) or {}
+        for d in deltas:
+            apply_delta(app.setdefault(d['sha'], {}).setdefault(d['entrypoint'], {}), d)
 
-    def remove_container(self, container):
-        app = self.get_app(container.appname)
+        path = self.APP_PATH % appname
+        return self.write(path, json.dumps(squash_dict(app))) is not None
+
+    def publish_pending(self, appname):
+        """
+        把积攒的增量应用到 etcd 上, 代价只和变化的量有关.
+        全量标记过期了或者上次写失败了, 就从数据库全量重建一次.
+        写成功了才记进变更流, 变更流和 etcd 里的数据总是对得上.
+        """
+        with rds.lock(_APP_PUBLISH_LOCK % appname, timeout=60):
+            pipe = rds.pipeline()
+            pipe.lrange(_APP_PENDING_KEY % appname, 0, -1)
+            pipe.delete(_APP_PENDING_KEY % appname)
+            pending, _ = pipe.execute()
+
+            if not rds.exists(_APP_FULL_KEY % appname):
+                self.publish_app(appname)
+                return
+
+            if not pending:
+                return
+            deltas = [json.loads(d) for d in pending]
+            if not self.apply_deltas(appname, deltas):
+                # 增量丢了, 下次全量
+                rds.delete(_APP_FULL_KEY % appname)
+                return
+
+            now = time.time()
+            pipe = rds.pipeline()
+            for d in deltas:
+                append_feed(dict(d, app=appname, time=now), client=pipe)
+            pipe.execute()
+
+    def collect_app(self, appname):
+        """从数据库里算出 app 现在应该有的全部数据"""
+        r = self._collect_app(appname)
+        return r and r[1]
+
+    def _collect_app(self, appname):
+        """返回 (算进去的容器 id, 数据), app 不存在是 None"""
+        app = App.get_by_name(appname)
         if not app:
             return
 
-        addresses = container.get_ips()
-        backends = container.get_backends()
-
-        current_addresses = app.get(container.short_sha, {}).get(container.entrypoint, {}).get('addresses', [])
-        current_backends = app.get(container.short_sha, {}).get(container.entrypoint, {}).get('backends', [])
-
-        new_addresses = list(set(current_addresses).difference(set(addresses)))
-        new_backends = list(set(current_backends).difference(set(backends)))
+        containers = [c for c in app.list_containers(limit=None) if c.is_alive and not c.in_removal]
+        ips = ipam.get_ips_for_containers([c.container_id for c in containers])
 
-        entrypoint = app.setdefault(container.short_sha, {}).setdefault(container.entrypoint, {})
-        entrypoint['addresses'] = new_addresses
-        entrypoint['backends'] = new_backends
+        data = {}
+        for c in containers:
+            cips = ips.get(c.container_id, [])
+            data.setdefault(c.short_sha, {}).setdefault(c.entrypoint, {}).setdefault('addresses', []).extend(c.get_ips(cips))
+            data.setdefault(c.short_sha, {}).setdefault(c.entrypoint, {}).setdefault('backends', []).extend(c.get_backends(cips))
+        return [c.container_id for c in containers], squash_dict(data)
 
-        path = self.APP_PATH % container.appname
-        self.write(path, json.dumps(squash_dict(app)))
+    def write_app(self, appname, data):
+        path = self.APP_PATH % appname
+        return self.write(path, json.dumps(data)) is not None
 
     def publish_app(self, appname):
-        app = App.get_by_name(appname)
-        if not app:
+        r = self._collect_app(appname)
+        if r is None:
             return
+        container_ids, data = r
+        if self.write_app(appname, data):
+            # 容器 set 照着这次写进去的重建, 空字符串占位, app 没容器也有这个 key.
+            # 比全量标记多活一个周期, 标记过期之前 set 不会先没了
+            members = _APP_MEMBERS_KEY % appname
+            pipe = rds.pipeline()
+            pipe.delete(members)
+            pipe.sadd(members, '', *container_ids)
+            pipe.expire(members, SERVICE_DISCOVERY_FULL_INTERVAL * 2)
+            pipe.set(_APP_FULL_KEY % appname, 1, ex=SERVICE_DISCOVERY_FULL_INTERVAL)
+            pipe.execute()
+            # 全量重建可能改了增量以外的东西, 让消费者重新拿一次
+            append_feed({'op': 'full', 'app': appname, 'time': time.time()})
+
+
+class ShardedEtcdPublisher(EtcdPublisher):
+    """
+    每个 (app, sha, entrypoint) 一个 key:
+        /eru/service-shards/:appname/:sha/:entrypoint
+    值是 {"addresses": [...], "backends": [...]}.
+    改动只写涉及到的 key, 调用的地方都拿着 app 的发布锁, 直接读了改了写回去.
+    legacy_document 打开的时候同样的增量也写一份到 /eru/service-nodes/:appname,
+    老的读者不用改, 代价是每次改动比 single 多写几个分片, 读者都迁过来了就关掉.
+    """
+    APP_DIR = '/eru/service-shards/%s'
+    SHARD_PATH = '/eru/service-shards/%s/%s/%s'
+    legacy_document = bool(SERVICE_DISCOVERY_LEGACY_DOCUMENT)
 
-        data = {}
-        for c in app.list_containers(limit=None):
-            if not c.is_alive or c.in_removal:
+    def _read_shards(self, appname):
+        try:
+            r = etcd.read(self.APP_DIR % appname, recursive=True)
+        except EtcdKeyNotFound:
+            return {}
+        shards = {}
+        for node in r.leaves:
+            if node.dir:
                 continue
-            data.setdefault(c.short_sha, {}).setdefault(c.entrypoint, {}).setdefault('addresses', []).extend(c.get_ips())
-            data.setdefault(c.short_sha, {}).setdefault(c.entrypoint, {}).setdefault('backends', []).extend(c.get_backends())
+            sha, entrypoint = node.key.rsplit('/', 2)[-2:]
+            shards[(sha, entrypoint)] = json.loads(node.value)
+        return shards
 
-        path = self.APP_PATH % appname
-        self.write(path, json.dumps(squash_dict(data)))
+    def get_app(self, appname):
+        try:
+            app = {}
+            for (sha, entrypoint), value in self._read_shards(appname).iteritems():
+                app.setdefault(sha, {})[entrypoint] = value
+            return squash_dict(app) or None
+        except (EtcdException, ValueError):
+            return None
+
+    def _update_shard(self, path, deltas):
+        try:
+            shard, exists = json.loads(etcd.read(path).value), True
+        except EtcdKeyNotFound:
+            shard, exists = {}, False
+
+        for d in deltas:
+            apply_delta(shard, d)
 
+        if shard.get('addresses') or shard.get('backends'):
+            etcd.write(path, json.dumps(shard))
+        elif exists:
+            etcd.delete(path)
 
-etcd_publisher = EtcdPublisher()
+    @handle_exception
+    def apply_deltas(self, appname, deltas):
+        grouped = {}
+        for d in deltas:
+            grouped.setdefault((d['sha'], d['entrypoint']), []).append(d)
+
+        for (sha, entrypoint), ds in grouped.iteritems():
+            self._update_shard(self.SHARD_PATH % (appname, sha, entrypoint), ds)
+        if self.legacy_document:
+            return super(ShardedEtcdPublisher, self).apply_deltas(appname, deltas)
+        return True
+
+    @handle_exception
+    def write_app(self, appname, data):
+        """全量的时候直接覆盖, 多余的 key 删掉"""
+        stale = set(self._read_shards(appname))
+        for sha, entrypoints in data.iteritems():
+            for entrypoint, value in entrypoints.iteritems():
+                etcd.write(self.SHARD_PATH % (appname, sha, entrypoint), json.dumps(value))
+                stale.discard((sha, entrypoint))
+        for sha, entrypoint in stale:
+            try:
+                etcd.delete(self.SHARD_PATH % (appname, sha, entrypoint))
+            except EtcdKeyNotFound:
+                pass
+        if self.legacy_document:
+            return super(ShardedEtcdPublisher, self).write_app(appname, data)
+        return True
+
+
+if SERVICE_DISCOVERY_LAYOUT == 'sharded':
+    etcd_publisher = ShardedEtcdPublisher()
+else:
+    etcd_publisher = EtcdPublisher()
+
+
+def container_delta(container, op, ips=None):
+    return {
+        'op': op,
+        'sha': container.short_sha,
+        'entrypoint': container.entrypoint,
+        'addresses': container.get_ips(ips),
+        'backends': container.get_backends(ips),
+    }
 
 
 def _app_key(container):
@@ -131,21 +319,119 @@ def _agent_key(host):
     return _AGENT_CONTAINER_KEY % host.name
 
 
-def add_container_backends(container):
-    rds.hset(_app_key(container), container.entrypoint, _entrypoint_key(container))
-    backends = container.get_backends()
-    if backends:
-        rds.sadd(_entrypoint_key(container), *backends)
+def append_feed(change, client=None):
+    """
+    往变更流里追加一条, client 可以是 pipeline.
+    要在 app 的发布锁里, etcd 写成功之后调用.
+    """
+    if 'feed' not in _scripts:
+        _scripts['feed'] = rds.register_script(_FEED_APPEND_LUA)
+    return _scripts['feed'](keys=[_FEED_VERSION_KEY, _FEED_KEY],
+                               args=[json.dumps(change), SERVICE_DISCOVERY_FEED_SIZE],
+                               client=client)
 
-    #etcd_publisher.add_container(container)
 
+def feed_version():
+    return int(rds.get(_FEED_VERSION_KEY) or 0)
 
-def remove_container_backends(container):
-    backends = container.get_backends()
-    if backends:
-        rds.srem(_entrypoint_key(container), *backends)
 
-    #etcd_publisher.remove_container(container)
+def get_app_snapshot(appname):
+    """
+    返回 (版本号, etcd 里 app 的数据).
+    在发布锁里读, 这个 app 不会有写了 etcd 还没进变更流的改动,
+    从这个版本接着拿变更刚好不重不漏.
+    """
+    with rds.lock(_APP_PUBLISH_LOCK % appname, timeout=60):
+        return feed_version(), etcd_publisher.get_app(appname)
+
+
+def read_feed(since, appname=None, limit=1000):
+    """
+    返回 (下次从哪个版本接着拿, 变更列表, 是否需要重新全量).
+    since 之后的变更已经被裁掉的话, 消费者得重新拿全量再从当前版本继续.
+    """
+    pipe = rds.pipeline()
+    pipe.get(_FEED_VERSION_KEY)
+    pipe.zrange(_FEED_KEY, 0, 0, withscores=True)
+    pipe.zrangebyscore(_FEED_KEY, '(%d' % since, '+inf', start=0, num=limit)
+    version, oldest, changes = pipe.execute()
+
+    version = int(version or 0)
+    reset = bool(oldest) and since + 1 < int(oldest[0][1])
+    changes = [json.loads(c) for c in changes]
+    # 一次没拿完的话从最后一条接着拿
+    if len(changes) >= limit:
+        version = changes[-1]['version']
+    if appname:
+        changes = [c for c in changes if c['app'] == appname]
+    return version, changes, reset
+
+
+def wait_feed(since, timeout, interval=0.2):
+    """
+    等到版本号超过 since 返回 True, 超时返回 False.
+    轮询版本号, 不占着连接池里的连接; gevent 下 sleep 不会卡住别的请求.
+    """
+    deadline = time.time() + timeout
+    while True:
+        if feed_version() > since:
+            return True
+        left = deadline - time.time()
+        if left <= 0:
+            return False
+        time.sleep(min(interval, left))
+
+
+def _containers_deltas(containers, op):
+    ips = ipam.get_ips_for_containers([c.container_id for c in containers])
+    return [(c, container_delta(c, op, ips.get(c.container_id, []))) for c in containers]
+
+
+def _push_pending(pipe, container, delta):
+    """
+    容器已经算进去了(或者已经摘掉了)就不再排, 每个容器的增删都是幂等的.
+    增量最多留一个全量周期. 能过期说明这么久都没发布过,
+    全量标记也早就过期了, 下次发布会全量重建, 丢掉的增量不要紧.
+    """
+    if 'pending' not in _scripts:
+        _scripts['pending'] = rds.register_script(_PENDING_PUSH_LUA)
+    appname = container.appname
+    _scripts['pending'](keys=[_APP_MEMBERS_KEY % appname, _APP_PENDING_KEY % appname],
+                        args=[delta['op'], container.container_id, json.dumps(delta),
+                              SERVICE_DISCOVERY_FULL_INTERVAL],
+                        client=pipe)
+
+
+def add_containers_backends(containers):
+    """IP 一次批量查出来, redis 的改动一个 pipeline 写完"""
+    if not containers:
+        return
+    pipe = rds.pipeline()
+    for c, delta in _containers_deltas(containers, 'add'):
+        pipe.hset(_app_key(c), c.entrypoint, _entrypoint_key(c))
+        if delta['backends']:
+            pipe.sadd(_entrypoint_key(c), *delta['backends'])
+        _push_pending(pipe, c, delta)
+    pipe.execute()
+
+
+def remove_containers_backends(containers):
+    if not containers:
+        return
+    pipe = rds.pipeline()
+    for c, delta in _containers_deltas(containers, 'remove'):
+        if delta['backends']:
+            pipe.srem(_entrypoint_key(c), *delta['backends'])
+        _push_pending(pipe, c, delta)
+    pipe.execute()
+
+
+def add_container_backends(container):
+    add_containers_backends([container])
+
+
+def remove_container_backends(container):
+    remove_containers_backends([container])
 
 
 def add_container_for_agent(host, container):
@@ -156,10 +442,67 @@ def remove_container_for_agent(host, container_ids):
     rds.hdel(_agent_key(host), *container_ids)
 
 
-def publish_to_service_discovery(*appnames):
+def publish_to_service_discovery(*appnames, **kwargs):
+    """
+    SERVICE_DISCOVERY_PUBLISH_WINDOW 大于 0 的话, 同一个 app 的发布请求
+    攒一个窗口再一起写 etcd, 但最多延迟 SERVICE_DISCOVERY_PUBLISH_MAX_DELAY 秒.
+    摘流量的时候给 immediate=True, 不等窗口马上写, 不然容器停了 etcd 里还挂着.
+    """
+    immediate = kwargs.get('immediate', False)
     for appname in appnames:
         rds.publish(_APP_DISCOVERY_KEY, appname)
-        etcd_publisher.publish_app(appname)
+        if SERVICE_DISCOVERY_PUBLISH_WINDOW > 0 and not immediate:
+            _schedule_publish(appname)
+        else:
+            etcd_publisher.publish_pending(appname)
+
+
+def _window_keys_ttl():
+    # 万一任务丢了, 这些 key 过期之后还能重新排上
+    return int(SERVICE_DISCOVERY_PUBLISH_WINDOW + SERVICE_DISCOVERY_PUBLISH_MAX_DELAY) + 60
+
+
+def _schedule_publish(appname):
+    from eru.async.task import flush_service_discovery
+
+    now = time.time()
+    ttl = _window_keys_ttl()
+    pipe = rds.pipeline()
+    pipe.set(_APP_PUBLISH_FIRST_KEY % appname, now, ex=ttl, nx=True)
+    pipe.set(_APP_PUBLISH_LAST_KEY % appname, now, ex=ttl)
+    pipe.set(_APP_PUBLISH_SCHEDULED_KEY % appname, 1, ex=ttl, nx=True)
+    _, _, scheduled = pipe.execute()
+    if scheduled:
+        flush_service_discovery.apply_async(args=(appname,), countdown=SERVICE_DISCOVERY_PUBLISH_WINDOW)
+
+
+def flush_publish_window(appname):
+    """
+    窗口里还有新请求就再等等, 返回还要等的秒数;
+    安静了一个窗口或者等够了最大延迟就发布, 返回 0.
+    """
+    now = time.time()
+    first, last = rds.mget(_APP_PUBLISH_FIRST_KEY % appname, _APP_PUBLISH_LAST_KEY % appname)
+    first = float(first or now)
+    last = float(last or 0)
+
+    quiet = now - last
+    waited = now - first
+    if quiet < SERVICE_DISCOVERY_PUBLISH_WINDOW and waited < SERVICE_DISCOVERY_PUBLISH_MAX_DELAY:
+        return min(SERVICE_DISCOVERY_PUBLISH_WINDOW - quiet, SERVICE_DISCOVERY_PUBLISH_MAX_DELAY - waited)
+
+    # 先清掉标记再发布, 发布过程中来的请求会排下一个窗口
+    rds.delete(_APP_PUBLISH_FIRST_KEY % appname, _APP_PUBLISH_SCHEDULED_KEY % appname)
+    etcd_publisher.publish_pending(appname)
+    return 0
+
+
+def republish_service_discovery(*appnames):
+    """从数据库全量重建, 顺便丢掉还没发布的增量"""
+    for appname in appnames:
+        with rds.lock(_APP_PUBLISH_LOCK % appname, timeout=60):
+            rds.delete(_APP_PENDING_KEY % appname)
+            etcd_publisher.publish_app(appname)
 
 
 def set_flag_for_agent(container_ids):
@@ -1,5 +1,6 @@
 # coding: utf-8
 
+import base64
 from urlparse import urlparse
 
 def is_strict_url(u):
@@ -10,6 +11,25 @@ def is_strict_url(u):
         return False
 
 
+def encode_cursor(id):
+    """把分页的 id 包成一个不透明的 cursor"""
+    return base64.urlsafe_b64encode('id:%d' % id).rstrip('=')
+
+
+def decode_cursor(cursor):
+    """空 cursor 返回 None, 解不开的抛 ValueError"""
+    if not cursor:
+        return None
+    cursor = str(cursor)
+    try:
+        prefix, id = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).split(':', 1)
+    except (TypeError, ValueError):
+        raise ValueError('Bad cursor %s' % cursor)
+    if prefix != 'id':
+        raise ValueError('Bad cursor %s' % cursor)
+    return int(id)
+
+
 class Jsonized(object):
 
     def to_dict(self):
@@ -2,15 +2,20 @@
 import functools
 import inspect
 import json
+import time
 from datetime import datetime
 from decimal import Decimal
 
-from flask import request, Response, abort
+from flask import g, request, Response, abort
 
+from eru.config import SQLALCHEMY_REPLICA_STALENESS
 from eru.connection import rds
 from eru.utils import Jsonized
 
 
+REPLICA_WRITE_COOKIE = 'eru_last_write'
+
+
 def redis_lock(fmt):
     def _redis_lock(f):
         @functools.wraps(f)
@@ -24,6 +29,16 @@ def redis_lock(fmt):
     return _redis_lock
 
 
+def use_replica(f):
+    """只读接口, 查询走从库. 刚写过的客户端还是读主库, 免得读到旧数据"""
+    @functools.wraps(f)
+    def _(*args, **kwargs):
+        last_write = request.cookies.get(REPLICA_WRITE_COOKIE, type=float, default=0)
+        g.use_replica = time.time() - last_write > SQLALCHEMY_REPLICA_STALENESS
+        return f(*args, **kwargs)
+    return _
+
+
 def check_request_json(keys):
     if not isinstance(keys, list):
         keys = [keys, ]
@@ -1,5 +1,9 @@
 # coding:utf-8
+import gevent
+from gevent.lock import Semaphore
+
 from eru.agent import get_agent
+from eru.config import ERU_TASK_LOG_BATCH_SIZE, ERU_TASK_LOG_FLUSH_INTERVAL, ERU_TASK_LOG_TTL
 from eru.consts import (
     ERU_TASK_PUBKEY,
     ERU_TASK_LOGKEY,
@@ -11,6 +15,50 @@ from eru.consts import (
 from eru.connection import rds
 
 
+class _LogBuffer(object):
+    """
+    攒一批日志一起写: 一个 pipeline 里一次 RPUSH 加上每行一个 PUBLISH.
+    攒够 ERU_TASK_LOG_BATCH_SIZE 行就写, 不够的话后台每 ERU_TASK_LOG_FLUSH_INTERVAL 秒也写一次,
+    订阅的人还是一行一行收到.
+    """
+
+    def __init__(self, log_key, publish_key):
+        self.log_key = log_key
+        self.publish_key = publish_key
+        self.lines = []
+        self.lock = Semaphore()
+        self.flusher = gevent.spawn(self._flush_periodically)
+
+    def _flush_periodically(self):
+        while True:
+            gevent.sleep(ERU_TASK_LOG_FLUSH_INTERVAL)
+            self.flush()
+
+    def append(self, line):
+        self.lines.append(line)
+        if len(self.lines) >= ERU_TASK_LOG_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        # 两个 greenlet 都会 flush, 锁住保证顺序
+        with self.lock:
+            lines, self.lines = self.lines, []
+            if not lines:
+                return
+            pipe = rds.pipeline()
+            pipe.rpush(self.log_key, *lines)
+            pipe.expire(self.log_key, ERU_TASK_LOG_TTL)
+            for line in lines:
+                pipe.publish(self.publish_key, line)
+            pipe.execute()
+
+    def close(self):
+        # 拿着锁再 kill, 免得把写了一半的 flush 打断
+        with self.lock:
+            self.flusher.kill()
+        self.flush()
+
+
 class TaskNotifier(object):
 
     def __init__(self, task):
@@ -29,11 +77,14 @@ class TaskNotifier(object):
         rds.publish(self.publish_key, PUB_END_MESSAGE)
 
     def store_and_broadcast(self, iterable):
-        """iter完这个generator并且返回最后一个"""
+        """iter完这个generator并且返回最后一个, 日志是攒一批写一次的"""
         line = ''
-        for line in iterable:
-            rds.rpush(self.log_key, line)
-            rds.publish(self.publish_key, line)
+        buf = _LogBuffer(self.log_key, self.publish_key)
+        try:
+            for line in iterable:
+                buf.append(line)
+        finally:
+            buf.close()
         return line
 
     def get_store_logs(self):
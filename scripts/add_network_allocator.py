@@ -0,0 +1,40 @@
+# coding: utf-8
+"""
+升级的时候必须跑一次: network 表加上 allocator 列.
+model 里已经有这一列了, 不加的话所有 Network 的查询都会报 Unknown column,
+继续用 set 的部署也一样. 加过了再跑什么也不做.
+python add_network_allocator.py
+"""
+from functools import wraps
+
+from sqlalchemy import inspect
+
+from eru.app import create_app_with_celery
+from eru.models import db
+
+
+def with_app_context(f):
+    @wraps(f)
+    def _(*args, **kwargs):
+        app, _ = create_app_with_celery()
+        with app.app_context():
+            return f(*args, **kwargs)
+    return _
+
+
+def has_allocator_column():
+    columns = [c['name'] for c in inspect(db.engine).get_columns('network')]
+    return 'allocator' in columns
+
+
+@with_app_context
+def migrate():
+    if has_allocator_column():
+        print 'network.allocator already exists'
+        return
+    db.engine.execute("ALTER TABLE network ADD COLUMN allocator CHAR(10) NOT NULL DEFAULT 'set'")
+    print 'network.allocator added'
+
+
+if __name__ == '__main__':
+    migrate()
@@ -1,11 +1,13 @@
 # coding: utf-8
+"""
+python fix_ip.py [network_name ...], 不给名字就修所有的.
+服务不用停, 一段一段对比数据库和 redis 里的 IP 池.
+"""
+import sys
 from functools import wraps
 
-import more_itertools
-
 from eru.app import create_app_with_celery
 from eru.models import Network
-from eru.connection import rds
 
 
 def with_app_context(f):
@@ -17,27 +19,20 @@ def with_app_context(f):
     return _
 
 
-def fix_ip(n):
-    network = n.network
-    base = int(network.network_address)
-    for ipnums in more_itertools.chunked(xrange(base+n.gateway_count, base+network.num_addresses), 500):
-        rds.sadd(n.storekey, *ipnums)
-
-    rds.sadd(n.gatekey, *range(base, base+n.gateway_count))
-
-    for ip in n.ips.all():
-        rds.srem(n.storekey, ip.ipnum)
-
-    for gateway in n.gates.all():
-        rds.srem(n.gatekey, gateway.ipnum)
-
-
 @with_app_context
-def fix_all_ips():
-    networks = Network.query.all()
+def fix_all_ips(names):
+    if names:
+        networks = [Network.get_by_name(name) for name in names]
+    else:
+        networks = Network.query.all()
+
     for n in networks:
-        fix_ip(n)
+        if not n:
+            continue
+        r = n.reconcile()
+        print '%s: %s leaked, %s double assigned, %s gateway leaked, %s gateway double assigned' % (
+            n.name, r['leaked'], r['double_assigned'], r['gate_leaked'], r['gate_double_assigned'])
 
 
 if __name__ == '__main__':
-    fix_all_ips()
+    fix_all_ips(sys.argv[1:])
@@ -0,0 +1,53 @@
+# coding: utf-8
+"""
+把 macvlan network 的可用 IP 从 redis set 迁到 bitmap.
+python migrate_ip_bitmap.py [network_name ...], 不给名字就迁所有的.
+要先跑过 add_network_allocator.py.
+"""
+import sys
+from functools import wraps
+
+from eru.app import create_app_with_celery
+from eru.connection import rds
+from eru.models import db, Network
+from eru.models.ippool import SetIPPool, BitmapIPPool
+
+
+def with_app_context(f):
+    @wraps(f)
+    def _(*args, **kwargs):
+        app, _ = create_app_with_celery()
+        with app.app_context():
+            return f(*args, **kwargs)
+    return _
+
+
+def migrate_network(n):
+    if n.allocator == BitmapIPPool.name:
+        print '%s already uses bitmap' % n.name
+        return
+
+    # 迁移的时候不能有人在分配 IP
+    with rds.lock('net:acquire_ip:%s' % n.id):
+        old, new = SetIPPool(n), BitmapIPPool(n)
+        new.init(old.ipnums())
+        n.allocator = BitmapIPPool.name
+        db.session.add(n)
+        db.session.commit()
+        old.clear()
+    print '%s migrated, %s free ips' % (n.name, n.pool_size)
+
+
+@with_app_context
+def migrate(names):
+    if names:
+        networks = [Network.get_by_name(name) for name in names]
+    else:
+        networks = Network.query.all()
+    for n in networks:
+        if n:
+            migrate_network(n)
+
+
+if __name__ == '__main__':
+    migrate(sys.argv[1:])
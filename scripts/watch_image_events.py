@@ -0,0 +1,77 @@
+# coding: utf-8
+"""
+python watch_image_events.py [host_name ...], 不给名字就看所有活着的机器.
+盯着 docker 的 events, 镜像有变化就更新 eru 里这台机器的镜像列表,
+不跑这个也行, 列表过期了会自己重新拉.
+"""
+import sys
+import time
+import threading
+from functools import wraps
+
+from eru.app import create_app_with_celery
+from eru.connection import get_docker_client
+from eru.models import Host
+
+
+_IMAGE_EVENTS = ('pull', 'tag', 'untag', 'delete', 'import', 'load')
+_app = None
+
+
+def with_app_context(f):
+    @wraps(f)
+    def _(*args, **kwargs):
+        with _app.app_context():
+            return f(*args, **kwargs)
+    return _
+
+
+@with_app_context
+def watch_host(host_id):
+    host = Host.get(host_id)
+    while True:
+        try:
+            client = get_docker_client(host.addr)
+            # 断开期间的变化不知道, 先整个刷一次
+            host.refresh_images()
+            for event in client.events(decode=True):
+                status = event.get('status')
+                if status not in _IMAGE_EVENTS:
+                    continue
+                # pull 的 id 就是 repo:tag, 别的只给镜像 id, 整个刷吧
+                if status == 'pull':
+                    host.add_images(event['id'])
+                else:
+                    host.refresh_images()
+                print 'host %s: %s %s' % (host.name, status, event.get('id'))
+        except Exception as e:
+            print 'host %s: %s, reconnect later' % (host.name, e)
+        time.sleep(5)
+
+
+@with_app_context
+def get_host_ids(names):
+    if names:
+        hosts = [Host.get_by_name(name) for name in names]
+    else:
+        hosts = Host.query.filter_by(is_alive=True).all()
+    return [h.id for h in hosts if h]
+
+
+def main(names):
+    global _app
+    _app, _ = create_app_with_celery()
+
+    threads = []
+    for host_id in get_host_ids(names):
+        t = threading.Thread(target=watch_host, args=(host_id,))
+        t.daemon = True
+        t.start()
+        threads.append(t)
+
+    while any(t.is_alive() for t in threads):
+        time.sleep(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -2,6 +2,8 @@
 
 import contextlib
 
+from etcd import EtcdKeyNotFound
+
 from tests.utils import random_sha1
 
 
@@ -19,6 +21,59 @@ class FakeEtcd(object):
     write = set
 
 
+class FakeEtcdResult(object):
+
+    def __init__(self, key, value=None, index=0, children=None):
+        self.key = key
+        self.value = value
+        self.modifiedIndex = index
+        self.dir = children is not None
+        self._children = children or []
+
+    @property
+    def leaves(self):
+        return self._children if self.dir else [self]
+
+
+class FakeEtcdClient(object):
+    """
+    内存里的 python-etcd client, 有 modifiedIndex,
+    支持 recursive read 和 delete.
+    """
+
+    def __init__(self):
+        self._data = {}
+        self._index = 0
+
+    def read(self, key, recursive=False, **kw):
+        key = key.rstrip('/')
+        if key in self._data:
+            value, index = self._data[key]
+            return FakeEtcdResult(key, value, index)
+        prefix = key + '/'
+        children = [FakeEtcdResult(k, v, i) for k, (v, i) in sorted(self._data.iteritems())
+                    if k.startswith(prefix)]
+        if not children:
+            raise EtcdKeyNotFound('Key not found : %s' % key)
+        return FakeEtcdResult(key, index=self._index, children=children)
+    get = read
+
+    def write(self, key, value, **kw):
+        self._index += 1
+        self._data[key] = (value, self._index)
+        return FakeEtcdResult(key, value, self._index)
+    set = write
+
+    def delete(self, key, **kw):
+        if key not in self._data:
+            raise EtcdKeyNotFound('Key not found : %s' % key)
+        self._index += 1
+        del self._data[key]
+
+    def keys(self):
+        return sorted(self._data)
+
+
 class FakeCeleryTask(object):
     """直接执行celery"""
     def __init__(self, fn):
@@ -36,3 +36,14 @@ def test_container_status(client, test_db):
         d = json.loads(rv.data)
         assert d['status'] == 0
 
+
+def test_container_remove_fails(client, test_db, monkeypatch):
+    app, version, pod, hosts, containers = create_test_suite()
+    c = containers[0]
+    monkeypatch.setattr('eru.api.container.dockerjob.remove_container_by_cid',
+                        lambda cids, host: {cid: 'device or resource busy' for cid in cids})
+
+    rv = client.delete('/api/container/%s/' % c.container_id)
+    assert rv.status_code == 500
+    d = json.loads(rv.data)
+    assert d['error'] == 'device or resource busy'
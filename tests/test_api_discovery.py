@@ -0,0 +1,35 @@
+# coding: utf-8
+
+import json
+import time
+
+from eru.publish import append_feed
+
+
+def _change(app, version):
+    return {'op': 'add', 'app': app, 'sha': 'abcdefg', 'entrypoint': 'web',
+            'addresses': ['10.0.0.%s' % version], 'backends': []}
+
+
+def test_feed(client, test_db):
+    append_feed(_change('app0', 1))
+    append_feed(_change('app1', 2))
+
+    rv = client.get('/api/discovery/feed/?since=0&timeout=0')
+    assert rv.status_code == 200
+    r = json.loads(rv.data)
+    assert r['version'] == 2
+    assert [c['app'] for c in r['changes']] == ['app0', 'app1']
+    assert not r['reset']
+
+
+def test_feed_app_filter_keeps_waiting(client, test_db):
+    append_feed(_change('app1', 1))
+
+    # 别的 app 的变更不会让请求马上返回
+    start = time.time()
+    rv = client.get('/api/discovery/feed/?since=0&app=app0&timeout=1')
+    assert time.time() - start >= 1
+    r = json.loads(rv.data)
+    assert r['changes'] == []
+    assert r['version'] == 1
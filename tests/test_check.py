@@ -0,0 +1,75 @@
+# coding: utf-8
+
+import gevent
+import requests
+
+from eru.helpers import check
+
+
+class FakeResponse(object):
+
+    def __init__(self, ok):
+        self.ok = ok
+
+
+class FakeSession(object):
+    """backend 在 fail_times 次之后才通过, 负数表示一直不通"""
+
+    def __init__(self, **fail_times):
+        self.fail_times = fail_times
+        self.calls = []
+
+    def get(self, url, timeout=None):
+        self.calls.append((url, timeout))
+        backend = url[len('http://'):].split('/', 1)[0]
+        tries = len([u for u, _ in self.calls if u.startswith('http://%s/' % backend)])
+        left = self.fail_times.get(backend, 0)
+        if left < 0 or tries <= left:
+            raise requests.exceptions.ConnectionError()
+        return FakeResponse(True)
+
+
+def _patch(monkeypatch, session):
+    sleeps = []
+    sleep = gevent.sleep
+
+    def _sleep(seconds):
+        sleeps.append(seconds)
+        sleep(0)
+
+    monkeypatch.setattr(check, '_session', session)
+    monkeypatch.setattr(check.gevent, 'sleep', _sleep)
+    return sleeps
+
+
+def test_health_check_options():
+    assert check.get_health_check_options('/healthz') == dict(check.DEFAULT_OPTIONS, path='/healthz')
+    assert check.get_health_check_options(None)['path'] == ''
+
+    options = check.get_health_check_options({'path': '/ping', 'timeout': 2, 'retries': 3, 'unknown': 1})
+    assert options == dict(check.DEFAULT_OPTIONS, path='/ping', timeout=2, retries=3)
+
+
+def test_check_health_backoff(monkeypatch):
+    session = FakeSession(a=2)
+    sleeps = _patch(monkeypatch, session)
+
+    health_check = {'path': '/ping', 'timeout': 3, 'retries': 5, 'interval': 0.5, 'max_interval': 0.8}
+    assert check.check_health(['a'], health_check) == {'a': True}
+    assert session.calls == [('http://a/ping', 3)] * 3
+    # 每次翻倍, 不超过 max_interval
+    assert sleeps == [0.5, 0.8]
+
+
+def test_check_health_gives_up(monkeypatch):
+    session = FakeSession(a=0, b=-1)
+    sleeps = _patch(monkeypatch, session)
+
+    reported = []
+    health_check = {'path': '/ping', 'retries': 4, 'interval': 0.1, 'max_interval': 1}
+    results = check.check_health(['a', 'b'], health_check, on_result=lambda b, ok: reported.append((b, ok)))
+    assert results == {'a': True, 'b': False}
+    assert sorted(reported) == [('a', True), ('b', False)]
+    assert len([u for u, _ in session.calls if u.startswith('http://b/')]) == 4
+    # 最后一次失败之后不用再等
+    assert sleeps == [0.1, 0.2, 0.4]
@@ -0,0 +1,123 @@
+# coding: utf-8
+
+import pytest
+from etcd import EtcdWatchTimedOut, EtcdEventIndexCleared
+from netaddr import IPAddress
+
+pytest.importorskip('pycalico')
+
+from pycalico.datastore_datatypes import IPPool
+
+from eru.connection import rds
+from eru.ipam import calico
+
+
+class _StopWatch(BaseException):
+    pass
+
+
+class FakeIPAMClient(object):
+
+    def __init__(self, *cidrs):
+        self.pools = [IPPool(c) for c in cidrs]
+        self.loads = 0
+
+    def get_ip_pools(self, version):
+        self.loads += 1
+        return self.pools
+
+
+class FakeWatchResult(object):
+
+    def __init__(self, index):
+        self.modifiedIndex = index
+
+
+@pytest.fixture
+def pool_table(test_db, monkeypatch):
+    client = FakeIPAMClient('10.1.0.0/16', '10.1.2.0/24')
+    rds.set(calico._POOL_NAME_KEY % '10.1.0.0/16', 'wide')
+    rds.set(calico._POOL_NAME_KEY % '10.1.2.0/24', 'narrow')
+    monkeypatch.setattr('eru.ipam.calico._ipam', client)
+    monkeypatch.setattr(calico._PoolTable, '_ensure_watcher', lambda self: None)
+
+    table = calico._PoolTable(60)
+    monkeypatch.setattr('eru.ipam.calico._pool_table', table)
+    return table, client
+
+
+def test_pool_table_lookup(pool_table):
+    table, client = pool_table
+
+    pool, name = table.lookup(IPAddress('10.1.2.3'))
+    assert str(pool.cidr) == '10.1.2.0/24'
+    assert name == 'narrow'
+
+    pool, name = table.lookup(IPAddress('10.1.3.3'))
+    assert str(pool.cidr) == '10.1.0.0/16'
+    assert name == 'wide'
+
+    assert table.lookup(IPAddress('192.168.0.1')) == (None, None)
+    assert len(table.all()) == 2
+    assert client.loads == 1
+
+    table.invalidate()
+    table.lookup(IPAddress('10.1.2.3'))
+    assert client.loads == 2
+
+
+def test_pool_table_watch_resets_index(pool_table, monkeypatch):
+    table, _ = pool_table
+    calls = []
+
+    def watch(path, index=None, recursive=False):
+        calls.append(index)
+        if len(calls) == 1:
+            return FakeWatchResult(10)
+        if len(calls) == 2:
+            # 上面的变更作废了缓存, 先重新加载, 再来一次空闲超时
+            table.all()
+            raise EtcdWatchTimedOut('Watch timed out')
+        if len(calls) == 3:
+            # index 太旧, etcd 已经把那段事件清掉了
+            raise EtcdEventIndexCleared('The event in requested index is outdated and cleared')
+        raise _StopWatch()
+
+    monkeypatch.setattr('eru.ipam.calico.etcd.watch', watch)
+    monkeypatch.setattr('eru.ipam.calico.time.sleep', lambda s: None)
+
+    with pytest.raises(_StopWatch):
+        table._watch()
+    # 超时不动 index, 出错了才从头 watch
+    assert calls == [None, 11, 11, None]
+    assert table._loaded_at == 0
+
+
+def test_pool_table_watch_timeout_keeps_table(pool_table, monkeypatch):
+    table, client = pool_table
+    calls = []
+
+    def watch(path, index=None, recursive=False):
+        calls.append(index)
+        if len(calls) < 3:
+            raise EtcdWatchTimedOut('Watch timed out')
+        raise _StopWatch()
+
+    monkeypatch.setattr('eru.ipam.calico.etcd.watch', watch)
+
+    table.all()
+    with pytest.raises(_StopWatch):
+        table._watch()
+    assert calls == [None, None, None]
+    table.all()
+    assert client.loads == 1
+
+
+def test_load_ip_skips_unknown_pool(pool_table, monkeypatch):
+    ips = [IPAddress('10.1.2.3'), IPAddress('192.168.0.1')]
+    monkeypatch.setattr('eru.ipam.calico._get_container_ips', lambda cid: ips)
+
+    wrapped = calico.CalicoIPAM().load_ip_by_container('cid')
+    assert len(wrapped) == 1
+    assert wrapped[0].address == '10.1.2.3'
+    assert wrapped[0].vlan_address == '10.1.2.3/24'
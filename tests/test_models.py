@@ -4,9 +4,13 @@ import operator
 from decimal import Decimal as D
 from more_itertools import chunked
 
-from eru.models import Pod, Host, App, Container, Network, VLanGateway
+from eru.connection import rds
+from eru.ipam import ipam
+from eru.models import db, Pod, Host, App, Container, Network, IP, VLanGateway
 from eru.helpers.scheduler import get_max_container_count, centralized_schedule
+from eru.utils import encode_cursor, decode_cursor
 
+from tests.prepare import create_test_suite
 from tests.utils import random_ipv4, random_string, random_uuid, random_sha1
 
 def test_group_pod(test_db):
@@ -42,6 +46,28 @@ def test_pod(test_db):
     assert p2.get_core_allocation(0.81) == (0, 81)
     assert p2.get_core_allocation(0.14) == (0, 14)
 
+def test_pod_hosts(test_db):
+    p1 = Pod.create('p1', 'p1')
+    p2 = Pod.create('p2', 'p2')
+    hosts = [Host.create(p1, random_ipv4(), random_string(prefix='host'),
+        random_uuid(), 4, 4096) for i in range(5)]
+
+    hosts[0].set_public()
+    hosts[1].set_public()
+    hosts[2].is_alive = False
+    db.session.add(hosts[2])
+    db.session.commit()
+
+    assert {h.id for h in p1.get_private_hosts()} == {hosts[3].id, hosts[4].id}
+    assert {h.id for h in p1.get_free_public_hosts(10)} == {hosts[0].id, hosts[1].id}
+    assert len(p1.get_free_public_hosts(1)) == 1
+    assert p2.get_free_public_hosts(None) == []
+
+    assert p1.host_count() == 5
+    assert p2.host_count() == 0
+    assert Pod.get_host_counts([p1.id, p2.id]) == {p1.id: 5}
+    assert {p.name: p.to_dict()['host_count'] for p in Pod.list_all()} == {'p1': 5, 'p2': 0}
+
 def test_host(test_db):
     p = Pod.create('pod', 'pod', 10, -1)
     hosts = [Host.create(p, random_ipv4(), random_string(prefix='host'),
@@ -429,3 +455,134 @@ def test_network(test_db):
     assert n.gate_pool_size == 100
     assert VLanGateway.get_by_host_and_network(host.id, n.id) is None
     assert len(host.list_vlans()) == 0
+
+def test_network_bitmap(test_db):
+    n = Network.create('bitnet', '10.2.0.0/22', gateway_count=10, allocator='bitmap')
+    assert n is not None
+    assert n.allocator == 'bitmap'
+    assert n.pool_size == 1014
+    assert n.used_count == 0
+
+    ip = n.acquire_ip()
+    assert ip.address == '10.2.0.10'
+    assert n.pool_size == 1013
+    assert not n.contains_ip('10.2.0.10')
+    assert n.contains_ip('10.2.0.11')
+    assert not n.contains_ip('10.2.0.1')
+    assert not n.contains_ip('10.3.0.1')
+
+    ip2 = n.acquire_specific_ip('10.2.3.255')
+    assert ip2 is not None
+    assert n.acquire_specific_ip('10.2.3.255') is None
+    assert n.pool_size == 1012
+
+    ip.release()
+    ip2.release()
+    assert n.pool_size == 1014
+    assert n.contains_ip('10.2.0.10')
+
+    assert Network.create('badnet', '10.3.0.0/24', allocator='nope') is None
+
+def test_network_bitmap_layout(test_db):
+    # 网关那几位是 1, 网段外补齐的位是 0
+    n = Network.create('bitnet29', '10.6.0.0/29', gateway_count=3, allocator='bitmap')
+    assert rds.get(n.ip_pool.key) == '\xe0'
+    m = Network.create('bitnet30', '10.6.1.0/30', gateway_count=1, allocator='bitmap')
+    assert rds.get(m.ip_pool.key) == '\x80'
+    assert m.pool_size == 3
+
+    # 迁移的时候拿已有的可用 IP 重建
+    m.ip_pool.init([m.network.first + 2])
+    assert rds.get(m.ip_pool.key) == '\xd0'
+    assert m.pool_size == 1
+
+def test_network_batch_acquire(test_db):
+    for allocator in ('set', 'bitmap'):
+        n = Network.create('net-%s' % allocator, '10.4.0.0/24', gateway_count=10, allocator=allocator)
+        ips = n.acquire_ips(20)
+        assert len(ips) == 20
+        assert len(set(ip.ipnum for ip in ips)) == 20
+        assert len(n.ips.all()) == 20
+        assert n.pool_size == 226
+        assert Network.get_pool_sizes([n]) == [226]
+        assert not any(n.contains_ip(ip.address) for ip in ips)
+
+        assert len(n.acquire_ips(1000)) == 226
+        assert n.pool_size == 0
+
+        IP.release_many(n.ips.all())
+        assert len(n.ips.all()) == 0
+        assert n.pool_size == 246
+        n.delete()
+
+def test_network_reconcile(test_db):
+    for allocator in ('set', 'bitmap'):
+        n = Network.create('net-%s' % allocator, '10.8.0.0/22', gateway_count=10, allocator=allocator)
+        ips = n.acquire_ips(5)
+        n.ip_pool.pop_many(2)
+        n.ip_pool.put(ips[0].ipnum)
+        rds.srem(n.gatekey, n.network.first + 3)
+        assert n.pool_size == 1008
+
+        r = n.reconcile(chunk_size=100)
+        assert r == {'leaked': 2, 'double_assigned': 1, 'gate_leaked': 1, 'gate_double_assigned': 0}
+        assert n.pool_size == 1009
+        assert not n.contains_ip(ips[0].address)
+        assert n.gate_pool_size == 10
+        assert sum(n.reconcile().values()) == 0
+        n.delete()
+
+def test_keyset_pagination(test_db):
+    app, version, pod, hosts, containers = create_test_suite()
+    ids = sorted([c.id for c in containers], reverse=True)
+
+    page = app.list_containers(limit=2)
+    assert [c.id for c in page] == ids[:2]
+
+    page = app.list_containers(limit=2, before=page[-1].id)
+    assert [c.id for c in page] == ids[2:4]
+    assert app.list_containers(limit=2, before=ids[-1]) == []
+
+    assert [c.id for c in version.list_containers(limit=None, before=ids[0])] == ids[1:]
+    assert [h.id for h in pod.list_hosts(limit=None)] == sorted([h.id for h in hosts], reverse=True)
+
+    assert decode_cursor(encode_cursor(ids[0])) == ids[0]
+    assert decode_cursor('') is None
+
+def test_container_ip_cache(test_db):
+    _, _, _, _, containers = create_test_suite()
+    n = Network.create('net', '10.5.0.0/24')
+    c = containers[0]
+    ip = n.acquire_ip()
+    c.ips.append(ip)
+    db.session.commit()
+
+    cids = [x.container_id for x in containers]
+    ips = ipam.get_ips_for_containers(cids)
+    assert [str(i) for i in ips[c.container_id]] == [ip.address]
+    assert all(ips[cid] == [] for cid in cids[1:])
+    # 第二次从缓存拿
+    assert c.get_ips() == [ip.address]
+    assert c.get_backends(ips[c.container_id]) == ['%s:5000' % ip.address]
+
+    ipam.release_ip_by_container(c.container_id)
+    assert c.get_ips() == []
+
+
+def test_host_images(test_db):
+    p = Pod.create('pod', 'pod', 10, -1)
+    host = Host.create(p, random_ipv4(), random_string(prefix='host'),
+        random_uuid(), 4, 4096)
+
+    host.refresh_images([])
+    assert not host.has_image('eru/app:abc')
+    host.add_images('eru/app:abc', 'eru/app:def')
+    assert host.has_image('eru/app:abc')
+    host.remove_images('eru/app:abc')
+    assert not host.has_image('eru/app:abc')
+    assert host.has_image('eru/app:def')
+    assert rds.ttl(host._images_key) > 0
+
+    host.refresh_images(['eru/base:1'])
+    assert host.has_image('eru/base:1')
+    assert not host.has_image('eru/app:def')
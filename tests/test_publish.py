@@ -0,0 +1,355 @@
+# coding: utf-8
+
+import json
+import time
+
+import pytest
+from etcd import EtcdException
+
+from eru.config import SERVICE_DISCOVERY_FULL_INTERVAL
+from eru.connection import rds
+from eru.models import db
+from eru.publish import (apply_delta, etcd_publisher, add_containers_backends,
+        remove_containers_backends,
+        EtcdPublisher, ShardedEtcdPublisher, append_feed, read_feed, wait_feed,
+        feed_version, get_app_snapshot,
+        publish_to_service_discovery, flush_publish_window,
+        _APP_PENDING_KEY, _APP_FULL_KEY, _APP_PUBLISH_FIRST_KEY,
+        _APP_PUBLISH_LAST_KEY, _APP_PUBLISH_SCHEDULED_KEY)
+from tests.mock import FakeEtcdClient
+from tests.prepare import create_test_suite
+
+
+@pytest.fixture
+def fake_etcd(monkeypatch):
+    client = FakeEtcdClient()
+    monkeypatch.setattr('eru.publish.etcd', client)
+    return client
+
+
+def _host_network_suite():
+    """web 用 host 网络, 前两个容器放在同一台机器上, 报的地址是一样的"""
+    app, version, pod, hosts, containers = create_test_suite()
+    appconfig = version.appconfig
+    appconfig.entrypoints['web']['network_mode'] = 'host'
+    appconfig.save()
+
+    # appname 是从容器名字里取的
+    for i, c in enumerate(containers):
+        c.name = '%s_web_%s' % (app.name, i)
+        db.session.add(c)
+    containers[1].host_id = containers[0].host_id
+    db.session.commit()
+    return app, containers
+
+
+def _normalize(data):
+    return {sha: {name: {k: sorted(v) for k, v in entrypoint.iteritems()}
+                  for name, entrypoint in entrypoints.iteritems()}
+            for sha, entrypoints in (data or {}).iteritems()}
+
+
+def _assert_published(publisher, appname):
+    assert _normalize(publisher.get_app(appname)) == _normalize(publisher.collect_app(appname))
+
+
+def test_apply_delta():
+    def delta(op, ip):
+        return {'op': op, 'addresses': [ip], 'backends': ['%s:5000' % ip]}
+
+    entrypoint = {}
+    apply_delta(entrypoint, delta('add', '10.0.0.1'))
+    apply_delta(entrypoint, delta('add', '10.0.0.1'))
+    apply_delta(entrypoint, delta('add', '10.0.0.2'))
+    assert sorted(entrypoint['addresses']) == ['10.0.0.1', '10.0.0.1', '10.0.0.2']
+
+    # 两个容器共用 10.0.0.1, 删掉一个还剩一份
+    apply_delta(entrypoint, delta('remove', '10.0.0.1'))
+    assert sorted(entrypoint['addresses']) == ['10.0.0.1', '10.0.0.2']
+    assert sorted(entrypoint['backends']) == ['10.0.0.1:5000', '10.0.0.2:5000']
+
+    apply_delta(entrypoint, delta('remove', '10.0.0.1'))
+    apply_delta(entrypoint, delta('remove', '10.0.0.9'))
+    assert entrypoint == {'addresses': ['10.0.0.2'], 'backends': ['10.0.0.2:5000']}
+
+
+def test_publish_pending(test_db, fake_etcd):
+    app, containers = _host_network_suite()
+
+    add_containers_backends(containers)
+    pending = _APP_PENDING_KEY % app.name
+    assert rds.llen(pending) == len(containers)
+    assert 0 < rds.ttl(pending) <= SERVICE_DISCOVERY_FULL_INTERVAL
+
+    # 还没有全量标记, 第一次从数据库重建
+    etcd_publisher.publish_pending(app.name)
+    assert rds.exists(_APP_FULL_KEY % app.name)
+    assert not rds.exists(pending)
+    _assert_published(etcd_publisher, app.name)
+
+    # 之后只应用增量, 同一台机器上还有别的容器, 地址不能被删掉
+    c = containers[0]
+    c.kill()
+    assert not rds.exists(pending)
+    _assert_published(etcd_publisher, app.name)
+    data = etcd_publisher.get_app(app.name)
+    assert c.host.ip in data[c.short_sha]['web']['addresses']
+
+
+def test_remove_after_kill(test_db, fake_etcd):
+    app, containers = _host_network_suite()
+    add_containers_backends(containers)
+    etcd_publisher.publish_pending(app.name)
+    pending = _APP_PENDING_KEY % app.name
+
+    # kill 的时候已经摘过了, 之后 remove_containers 再摘一次不能再排增量,
+    # 不然会把同一台机器上另一个容器的地址也删掉
+    c = containers[0]
+    c.kill()
+    remove_containers_backends([c])
+    assert not rds.exists(pending)
+    etcd_publisher.publish_pending(app.name)
+    _assert_published(etcd_publisher, app.name)
+    data = etcd_publisher.get_app(app.name)
+    assert data[c.short_sha]['web']['addresses'].count(c.host.ip) == 1
+
+    # 全量重建已经算进去的容器, 再加一次也不排
+    add_containers_backends(containers[1:])
+    assert not rds.exists(pending)
+
+
+def test_publish_pending_full_rebuild(test_db, fake_etcd, monkeypatch):
+    app, containers = _host_network_suite()
+    add_containers_backends(containers)
+    etcd_publisher.publish_pending(app.name)
+
+    def broken_write(*args, **kwargs):
+        raise EtcdException('etcd is down')
+
+    # 写 etcd 失败, 这次的增量没了, 全量标记也要清掉
+    write = fake_etcd.write
+    monkeypatch.setattr(fake_etcd, 'write', broken_write)
+    containers[2].kill()
+    assert not rds.exists(_APP_FULL_KEY % app.name)
+    assert not rds.exists(_APP_PENDING_KEY % app.name)
+
+    # 下次发布不管有没有增量都从数据库全量重建
+    monkeypatch.setattr(fake_etcd, 'write', write)
+    etcd_publisher.publish_pending(app.name)
+    assert rds.exists(_APP_FULL_KEY % app.name)
+    _assert_published(etcd_publisher, app.name)
+    data = etcd_publisher.get_app(app.name)
+    assert containers[2].host.ip not in data[containers[2].short_sha]['web']['addresses']
+
+
+@pytest.fixture
+def publish_window(test_db, monkeypatch):
+    """窗口 5 秒, 最多等 10 秒. 记下排了哪些 flush 任务和真正发布了哪些 app"""
+    from eru.async.task import flush_service_discovery
+
+    monkeypatch.setattr('eru.publish.SERVICE_DISCOVERY_PUBLISH_WINDOW', 5)
+    monkeypatch.setattr('eru.publish.SERVICE_DISCOVERY_PUBLISH_MAX_DELAY', 10)
+
+    scheduled, published = [], []
+    monkeypatch.setattr(flush_service_discovery, 'apply_async',
+                        lambda args, countdown: scheduled.append((args, countdown)))
+    monkeypatch.setattr(etcd_publisher, 'publish_pending', published.append)
+    return scheduled, published
+
+
+def test_flush_publish_window(publish_window):
+    scheduled, published = publish_window
+
+    publish_to_service_discovery('app')
+    publish_to_service_discovery('app')
+    assert scheduled == [(('app',), 5)]
+    assert published == []
+
+    # 窗口里还有请求, 再等等
+    delay = flush_publish_window('app')
+    assert 0 < delay <= 5
+    assert published == []
+
+    # 安静了一个窗口, 发布
+    rds.set(_APP_PUBLISH_LAST_KEY % 'app', time.time() - 6)
+    assert flush_publish_window('app') == 0
+    assert published == ['app']
+    assert not rds.exists(_APP_PUBLISH_SCHEDULED_KEY % 'app')
+
+    # 一直有请求的话, 等够最大延迟也要发布
+    publish_to_service_discovery('app')
+    assert len(scheduled) == 2
+    rds.set(_APP_PUBLISH_FIRST_KEY % 'app', time.time() - 11)
+    assert flush_publish_window('app') == 0
+    assert published == ['app', 'app']
+
+
+def test_publish_removal_skips_window(publish_window):
+    scheduled, published = publish_window
+
+    publish_to_service_discovery('app', immediate=True)
+    assert published == ['app']
+    assert scheduled == []
+
+
+def test_flush_service_discovery_reschedules(publish_window):
+    from eru.async.task import flush_service_discovery
+    scheduled, published = publish_window
+
+    publish_to_service_discovery('app')
+    assert len(scheduled) == 1
+
+    # 窗口没结束, 任务把自己往后排
+    flush_service_discovery('app')
+    assert len(scheduled) == 2
+    assert scheduled[-1][0] == ('app',)
+    assert 0 < scheduled[-1][1] <= 5
+    assert published == []
+
+    rds.set(_APP_PUBLISH_LAST_KEY % 'app', time.time() - 6)
+    flush_service_discovery('app')
+    assert len(scheduled) == 2
+    assert published == ['app']
+
+
+def _entrypoint(*ips):
+    return {'addresses': list(ips), 'backends': ['%s:5000' % ip for ip in ips]}
+
+
+def _shard_delta(op, ip, sha='abc', entrypoint='web'):
+    return dict(_entrypoint(ip), op=op, sha=sha, entrypoint=entrypoint)
+
+
+def test_sharded_write_app(fake_etcd):
+    publisher = ShardedEtcdPublisher()
+    fake_etcd.write(publisher.SHARD_PATH % ('app', 'old', 'web'), json.dumps(_entrypoint('10.0.0.1')))
+    fake_etcd.write(publisher.SHARD_PATH % ('app', 'abc', 'web'), json.dumps(_entrypoint('10.0.0.1')))
+
+    data = {
+        'abc': {'web': _entrypoint('10.0.0.2')},
+        'def': {'web': _entrypoint('10.0.0.3'), 'daemon': _entrypoint('10.0.0.3')},
+    }
+    assert publisher.write_app('app', data)
+
+    # 旧版本的分片删掉了, 没变的覆盖
+    assert fake_etcd.keys() == sorted([
+        EtcdPublisher.APP_PATH % 'app',
+        publisher.SHARD_PATH % ('app', 'abc', 'web'),
+        publisher.SHARD_PATH % ('app', 'def', 'daemon'),
+        publisher.SHARD_PATH % ('app', 'def', 'web'),
+    ])
+    assert publisher.get_app('app') == data
+    # 老的读者看到的是同样的数据
+    assert EtcdPublisher().get_app('app') == data
+
+
+def test_sharded_apply_deltas(fake_etcd):
+    publisher = ShardedEtcdPublisher()
+    assert publisher.apply_deltas('app', [
+        _shard_delta('add', '10.0.0.1'),
+        _shard_delta('add', '10.0.0.2'),
+        _shard_delta('add', '10.0.0.3', entrypoint='daemon'),
+    ])
+    expected = {'abc': {'web': _entrypoint('10.0.0.1', '10.0.0.2'),
+                        'daemon': _entrypoint('10.0.0.3')}}
+    assert _normalize(publisher.get_app('app')) == expected
+    assert _normalize(EtcdPublisher().get_app('app')) == expected
+
+    # 分片空了就删掉
+    assert publisher.apply_deltas('app', [_shard_delta('remove', '10.0.0.3', entrypoint='daemon')])
+    assert publisher.SHARD_PATH % ('app', 'abc', 'daemon') not in fake_etcd.keys()
+    expected = {'abc': {'web': _entrypoint('10.0.0.1', '10.0.0.2')}}
+    assert _normalize(EtcdPublisher().get_app('app')) == expected
+
+
+def test_sharded_without_legacy_document(fake_etcd, monkeypatch):
+    publisher = ShardedEtcdPublisher()
+    monkeypatch.setattr(publisher, 'legacy_document', False)
+
+    data = {'abc': {'web': _entrypoint('10.0.0.1')}}
+    assert publisher.write_app('app', data)
+    assert publisher.apply_deltas('app', [_shard_delta('add', '10.0.0.2')])
+
+    # 只写分片, 老路径上什么都没有
+    assert fake_etcd.keys() == [publisher.SHARD_PATH % ('app', 'abc', 'web')]
+    expected = {'abc': {'web': _entrypoint('10.0.0.1', '10.0.0.2')}}
+    assert _normalize(publisher.get_app('app')) == expected
+    assert EtcdPublisher().get_app('app') is None
+
+
+def _append_changes(count):
+    for i in range(count):
+        append_feed(dict(_shard_delta('add', '10.0.0.%s' % i), app='app%s' % (i % 2)))
+
+
+def test_read_feed(test_db, monkeypatch):
+    monkeypatch.setattr('eru.publish.SERVICE_DISCOVERY_FEED_SIZE', 5)
+    assert read_feed(0) == (0, [], False)
+
+    _append_changes(8)
+    assert feed_version() == 8
+
+    # 只留了最近 5 条
+    version, changes, reset = read_feed(3)
+    assert version == 8
+    assert [c['version'] for c in changes] == [4, 5, 6, 7, 8]
+    assert not reset
+    assert changes[0]['addresses'] == ['10.0.0.3']
+    assert changes[0]['app'] == 'app1'
+
+    version, changes, reset = read_feed(3, 'app1')
+    assert version == 8
+    assert [c['version'] for c in changes] == [4, 6, 8]
+
+    # 一次拿不完从最后一条接着拿
+    version, changes, reset = read_feed(4, limit=2)
+    assert version == 6
+    assert [c['version'] for c in changes] == [5, 6]
+
+    assert read_feed(8) == (8, [], False)
+
+
+def test_read_feed_reset(test_db, monkeypatch):
+    monkeypatch.setattr('eru.publish.SERVICE_DISCOVERY_FEED_SIZE', 5)
+    _append_changes(8)
+
+    # since 之后的 1 到 3 已经被裁掉了, 得重新拿全量
+    version, changes, reset = read_feed(0)
+    assert reset
+    assert version == 8
+    assert [c['version'] for c in changes] == [4, 5, 6, 7, 8]
+
+    assert read_feed(2)[2]
+    assert not read_feed(3)[2]
+
+
+def test_wait_feed(test_db):
+    _append_changes(1)
+    assert wait_feed(0, 1)
+
+    start = time.time()
+    assert not wait_feed(1, 0.3, interval=0.1)
+    assert time.time() - start >= 0.3
+
+
+def test_feed_follows_etcd(test_db, fake_etcd):
+    app, containers = _host_network_suite()
+
+    # 只是排队, 还没写 etcd, 变更流里不能有
+    add_containers_backends(containers)
+    assert feed_version() == 0
+
+    etcd_publisher.publish_pending(app.name)
+    version, changes, _ = read_feed(0)
+    assert [c['op'] for c in changes] == ['full']
+    assert changes[0]['app'] == app.name
+    assert get_app_snapshot(app.name) == (version, etcd_publisher.get_app(app.name))
+
+    c = containers[0]
+    c.kill()
+    version, changes, _ = read_feed(version)
+    assert len(changes) == 1
+    assert changes[0]['op'] == 'remove'
+    assert changes[0]['app'] == app.name
+    assert changes[0]['backends'] == c.get_backends()
+    assert get_app_snapshot(app.name)[0] == version
@@ -0,0 +1,75 @@
+# coding: utf-8
+
+import time
+
+from flask import g
+
+from eru.models import db
+from eru.utils.decorator import use_replica, REPLICA_WRITE_COOKIE
+from tests.prepare import create_test_suite
+
+
+def _use_replica_binds(app):
+    app.config['SQLALCHEMY_BINDS'] = {'replica0': 'sqlite://'}
+    app.config['SQLALCHEMY_REPLICA_BINDS'] = ['replica0']
+
+
+def test_replica_routing_session(app):
+    _use_replica_binds(app)
+    primary = db.get_engine(app)
+    replica = db.get_engine(app, 'replica0')
+
+    with app.test_request_context('/'):
+        session = db.session()
+        assert session.get_bind() is primary
+
+        g.use_replica = True
+        assert session.get_bind() is replica
+
+        # 写过之后同一个 session 都回主库
+        session.written = True
+        assert session.get_bind() is primary
+        db.session.remove()
+
+    # 没有请求的时候(celery 里)一直是主库
+    session = db.session()
+    assert session.get_bind() is primary
+    db.session.remove()
+
+
+def test_replica_routing_without_replica(app):
+    app.config['SQLALCHEMY_REPLICA_BINDS'] = []
+    with app.test_request_context('/'):
+        g.use_replica = True
+        assert db.session().get_bind() is db.get_engine(app)
+        db.session.remove()
+
+
+def test_last_write_guard(app):
+    view = use_replica(lambda: g.use_replica)
+
+    with app.test_request_context('/'):
+        assert view()
+
+    cookie = '%s=%s' % (REPLICA_WRITE_COOKIE, time.time())
+    with app.test_request_context('/', headers={'Cookie': cookie}):
+        assert not view()
+
+    cookie = '%s=%s' % (REPLICA_WRITE_COOKIE, time.time() - 3600)
+    with app.test_request_context('/', headers={'Cookie': cookie}):
+        assert view()
+
+
+def test_agent_routes_read_primary(client, test_db):
+    _, _, _, _, containers = create_test_suite()
+    c = containers[0]
+
+    # 测试里 app context 是共用的, g 会留到下一个请求
+    g.use_replica = False
+    rv = client.get('/api/container/%s/poll/' % c.container_id)
+    assert rv.status_code == 200
+    assert not g.use_replica
+
+    rv = client.get('/api/container/%s/' % c.container_id)
+    assert rv.status_code == 200
+    assert g.use_replica
@@ -4,6 +4,7 @@ from eru.models import Pod, Host
 from eru.helpers.scheduler import get_max_container_count
 from eru.helpers.scheduler import average_schedule
 from eru.helpers.scheduler import centralized_schedule
+from eru.helpers.scheduler import build_schedule, record_build
 from tests.utils import random_ipv4, random_uuid, random_string
 
 def _create_data(core_share, max_share_core, host_count):
@@ -188,3 +189,40 @@ def test_centralized_schedule(test_db):
             assert len(cores['full']) == 12
             assert len(cores['part']) == 6
             assert len(set(cores['part'])) == 2
+
+def test_schedule_prefer_image(test_db):
+    pod = _create_data(10, -1, 4)
+    hosts = pod.hosts.all()
+    for host in hosts:
+        host.refresh_images([])
+    hosts[2].add_images('eru/app:abc')
+
+    r = average_schedule(pod, ncontainer=1, ncore=1, prefer_image='eru/app:abc')
+    assert [host.id for host, _ in r.keys()] == [hosts[2].id]
+
+    r = average_schedule(pod, ncontainer=6, ncore=1, prefer_image='eru/app:abc')
+    assert {host.id: count for host, count in r.keys()}[hosts[2].id] == 2
+
+    r = centralized_schedule(pod, ncontainer=4, ncore=1, prefer_image='eru/app:abc')
+    assert [(host.id, count) for host, count in r.keys()] == [(hosts[2].id, 4)]
+
+def test_build_schedule(test_db):
+    pod = _create_data(10, -1, 3)
+    hosts = pod.hosts.all()
+    for host in hosts:
+        host.set_public()
+
+    record_build(hosts[1], 'app', 'base:1')
+    assert build_schedule('app', 'base:1').id == hosts[1].id
+
+    hosts[1].add_build(1)
+    host = build_schedule('app', 'base:1')
+    assert host.id != hosts[1].id
+
+    for i, host in enumerate(hosts):
+        host.add_build(10 + i)
+        host.add_build(20 + i)
+    assert build_schedule('app', 'base:1') is None
+
+    hosts[2].remove_build(22)
+    assert build_schedule('app', 'base:1').id == hosts[2].id
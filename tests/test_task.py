@@ -0,0 +1,25 @@
+# coding: utf-8
+
+from eru import consts
+from eru.async.task import _remove_drained_containers
+from eru.models import Container, Task
+from tests.prepare import create_test_suite
+
+
+def test_remove_drained_containers_all_fail(test_db, monkeypatch):
+    app, version, pod, hosts, containers = create_test_suite()
+    host = containers[0].host
+    containers = [c for c in containers if c.host_id == host.id]
+    cids = [c.container_id for c in containers]
+    task = Task.create(consts.TASK_REMOVE, version, host, {'container_ids': cids})
+
+    monkeypatch.setattr('eru.async.task.dockerjob.remove_host_containers',
+                        lambda containers, host: {c.container_id: 'boom' for c in containers})
+    _remove_drained_containers(task, containers, False)
+
+    # 一个都没删掉也要把 task 标成失败, 原因留下来
+    task = Task.get(task.id)
+    assert task.result == consts.TASK_FAILED
+    assert sorted(task.reason.split('; ')) == sorted('%s: boom' % cid[:7] for cid in cids)
+    for cid in cids:
+        assert Container.get_by_container_id(cid)